@@ -1,24 +1,106 @@
 import os
+import re
+import html
+import math
+import sys
+import copy
+import io
+import csv
+import json
+import queue
+import random
+import bisect
+import secrets
+import tracemalloc
+import hashlib
+import itertools
+import contextvars
+import unicodedata
 import time
+import asyncio
 import logging
-from typing import Dict, Tuple, Set, Any, List
-
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from logging.handlers import QueueHandler, QueueListener
+import sqlite3
+import aiohttp
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+import mmap
+import struct
+import zipfile
+import tempfile
+import threading
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple, Set, Any, List, Deque, Callable, Awaitable, Iterator
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types, F, __version__ as AIOGRAM_VERSION
 from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+
+# multibot.py загружает этот модуль по копии на бота и заранее кладет в каждую копию
+# один и тот же словарь HOST_SHARED: через него боты делят пул соединений, потоки и логирование
+HOSTED = "HOST_SHARED" in globals()
+if not HOSTED:
+    HOST_SHARED: Dict[str, Any] = {}
+
+# Загружаем .env локально (на Render переменные берутся из Environment); при хостинге
+# .env уже прочитал multibot.py, и окружение бота он собирает сам
+if not HOSTED:
+    load_dotenv()
+
+
+def shared_resource(name: str, factory: Callable[[], Any]) -> Any:
+    if name not in HOST_SHARED:
+        HOST_SHARED[name] = factory()
+    return HOST_SHARED[name]
 
-# Загружаем .env локально (на Render переменные берутся из Environment)
-load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# имя бота в логах при хостинге нескольких ботов в одном процессе
+BOT_NAME = os.getenv("BOT_NAME")
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
 ADMIN_CHAT_ID_STR = os.getenv("ADMIN_CHAT_ID")
+SEARCH_DB_PATH = os.getenv("SEARCH_DB_PATH", "messages.db")
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", "outbox.db")
+# токен для /debug/* (заголовок X-Debug-Token); не задан - отладочные маршруты выключены
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+# webhook - апдейты приходят на WEBHOOK_PATH; polling - бот сам забирает их через getUpdates
+UPDATES_MODE = os.getenv("UPDATES_MODE", "webhook").lower()
+# свои тексты для пользователей (JSON), например у каждого бота в multibot.py
+try:
+    BOT_TEXTS: Dict[str, Dict[str, str]] = json.loads(os.getenv("BOT_TEXTS") or "{}")
+except ValueError:
+    raise RuntimeError("BOT_TEXTS must be JSON object")
+# общий лимит соединений к Bot API на все боты процесса (только для multibot.py)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+# публичный адрес webhook; если известен, бот сам регистрирует его при старте (на Render - из RENDER_EXTERNAL_URL)
+_render_url = os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or (_render_url.rstrip("/") + WEBHOOK_PATH if _render_url else None)
+# секрет для заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена,
+# чтобы у всех воркеров он был одинаковым
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(
+    f"webhook:{BOT_TOKEN}".encode()
+).hexdigest()
+# явно заданный секрет проверяем всегда; выведенный из токена - только после того,
+# как setup_webhook передал его Telegram (см. webhook_state["secret_token_set"])
+WEBHOOK_SECRET_REQUIRED = bool(os.getenv("WEBHOOK_SECRET"))
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
@@ -31,11 +113,237 @@ try:
 except ValueError:
     raise RuntimeError("ADMIN_CHAT_ID must be integer (например -1001234567890)")
 
-logging.basicConfig(level=logging.INFO)
+# дополнительные админ-группы: пользователи распределяются между ними по хешу user_id
+try:
+    ADMIN_CHAT_POOL: List[int] = [ADMIN_CHAT_ID] + [
+        int(x) for x in os.getenv("ADMIN_CHAT_IDS", "").split(",") if x.strip()
+    ]
+except ValueError:
+    raise RuntimeError("ADMIN_CHAT_IDS must be comma-separated integers")
+ADMIN_CHAT_POOL = list(dict.fromkeys(ADMIN_CHAT_POOL))
+
+# типы тегов пользователей; новый тег - новая запись здесь: кнопка под сообщениями,
+# команда /<тег> со списком и своя группа ADMIN_CHAT_<ТЕГ> появятся сами.
+# immediate - сообщения таких пользователей не уходят в дайджест;
+# alert - о каждом новом посте такого пользователя в группе отдельное оповещение;
+# boost - на сколько секунд "старше" считаются его сообщения в /inbox (идут раньше)
+TAG_TYPES: Dict[str, Dict[str, Any]] = {
+    "watch": {
+        "icon": "👁",
+        "button": "Наблюдение",
+        "title": "Под наблюдением",
+        "on": "Добавлен под наблюдение.",
+        "off": "Метка снята.",
+        "immediate": True,
+        "alert": True,
+        "boost": 24 * 60 * 60,
+    },
+    "fav": {
+        "icon": "⭐",
+        "button": "Избранное",
+        "title": "Избранные",
+        "on": "Добавлен в избранное.",
+        "off": "Удалён из избранного.",
+        "immediate": True,
+        "alert": False,
+        "boost": 6 * 60 * 60,
+    },
+}
+
+# кого упомянуть в оповещении о сообщении от наблюдаемого, например "@ivan @petr"
+TAG_ALERT_MENTION = os.getenv("TAG_ALERT_MENTION", "")
+
+# выделенные группы для пользователей с тегом (например, всех "под наблюдением" - в одну);
+# при нескольких тегах - группа тега, который раньше в TAG_TYPES
+ADMIN_TAG_CHATS: Dict[str, int] = {}
+for _tag in TAG_TYPES:
+    _env = f"ADMIN_CHAT_{_tag.upper()}"
+    _value = os.getenv(_env)
+    if _value:
+        try:
+            ADMIN_TAG_CHATS[_tag] = int(_value)
+        except ValueError:
+            raise RuntimeError(f"{_env} must be integer")
+
+# все группы, в которых работают админские команды и кнопки
+ADMIN_CHAT_IDS: Set[int] = set(ADMIN_CHAT_POOL) | set(ADMIN_TAG_CHATS.values())
+
+if UPDATES_MODE not in ("webhook", "polling"):
+    raise RuntimeError("UPDATES_MODE must be 'webhook' or 'polling'")
+
+# --- Логирование: JSON-строки, запись в фоновом потоке, сэмплирование INFO ---
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
-app = FastAPI()
+# доля INFO-записей, которые пишем, по префиксу имени логгера: "aiogram.event=0.01,bot.updates=0.1"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "aiogram.event=0.01,bot.updates=0.1")
 
-session = AiohttpSession()
+# поля апдейта, которые попадают во все записи, сделанные во время его обработки
+log_context: ContextVar[Dict[str, Any]] = shared_resource(
+    "log_context", lambda: ContextVar("log_context", default={})
+)
+
+LOG_CONTEXT_FIELDS = ("bot", "update_id", "user_id", "handler", "duration_ms")
+
+
+def parse_log_sampling(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in spec.split(","):
+        if "=" not in part:
+            continue
+        name, rate = part.split("=", 1)
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            raise RuntimeError(f"LOG_SAMPLING: bad rate for {name.strip()!r}")
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю INFO/DEBUG записей шумных логгеров; WARNING и выше - всегда."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.cache: Dict[str, float] = {}
+
+    def rate_for(self, name: str) -> float:
+        rate = self.cache.get(name)
+        if rate is None:
+            rate = 1.0
+            best = -1
+            for prefix, value in self.rates.items():
+                if (name == prefix or name.startswith(prefix + ".")) and len(prefix) > best:
+                    rate, best = value, len(prefix)
+            self.cache[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class StructuredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # в очередь уходит запись без args/traceback-объектов, форматирование JSON - в потоке слушателя
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.msg,
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> QueueListener:
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_log_sampling(LOG_SAMPLING)))
+    queue_handler.addFilter(ContextFilter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+log_listener = shared_resource("log_listener", setup_logging)
+update_logger = logging.getLogger("bot.updates")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await load_history()
+    drain_task = asyncio.create_task(drain_deferred_sends())
+    outbox_task = asyncio.create_task(run_outbox())
+    maintenance_task = asyncio.create_task(run_maintenance())
+    digest_task = None
+    if DIGEST_MODE != "off":
+        digest_task = asyncio.create_task(run_digest())
+    polling_task = None
+    if UPDATES_MODE == "polling":
+        polling_task = asyncio.create_task(run_polling())
+    elif WEBHOOK_URL:
+        await setup_webhook()
+    yield
+    if polling_task is not None:
+        await stop_polling(polling_task)
+    if digest_task is not None:
+        digest_task.cancel()
+        # накопленное не теряем
+        await flush_digest()
+    maintenance_task.cancel()
+    outbox_task.cancel()
+    drain_task.cancel()
+    await close_history()
+    # общий логгер останавливает multibot.py после всех ботов
+    if not HOSTED:
+        log_listener.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class SharedPoolSession(AiohttpSession):
+    """Сессия aiogram поверх общего для всех ботов процесса пула соединений.
+
+    Middleware у каждого бота свои, а TCP/TLS-соединения к api.telegram.org - общие.
+    """
+
+    async def create_session(self) -> aiohttp.ClientSession:
+        # как AiohttpSession.create_session, только коннектор общий
+        if self._should_reset_connector:
+            await self.close()
+
+        if self._session is None or self._session.closed:
+            connector = shared_resource(
+                "http_connector", lambda: self._connector_type(**self._connector_init)
+            )
+            # connector_owner=False: закрытие сессии одного бота не рвет соединения остальных
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                connector_owner=False,
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{AIOGRAM_VERSION}"},
+            )
+            self._should_reset_connector = False
+        return self._session
+
+
+session = SharedPoolSession(limit=HTTP_POOL_LIMIT) if HOSTED else AiohttpSession()
 bot = Bot(
     token=BOT_TOKEN,
     session=session,
@@ -43,11 +351,34 @@ bot = Bot(
 )
 dp = Dispatcher()
 
+
+async def log_handler_timing(handler, event, data):
+    handler_obj = data.get("handler")
+    name = handler_obj.callback.__name__ if handler_obj else None
+    token = log_context.set({**log_context.get(), "handler": name})
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        update_logger.info(
+            "update handled",
+            extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)},
+        )
+        log_context.reset(token)
+
+
+dp.message.middleware(log_handler_timing)
+dp.callback_query.middleware(log_handler_timing)
+
 # --- Глобальные структуры ---
 
 # (chat_id, bot_message_id) -> user_id (для ответов из группы)
 message_targets: Dict[Tuple[int, int], int] = {}
 
+# копия (стикер под шапкой, хвост альбома) -> пост, к которому она относится;
+# ответ на копию засчитываем посту (время ответа, /inbox)
+message_roots: Dict[Tuple[int, int], Tuple[int, int]] = {}
+
 # защита от повторной обработки одного и того же апдейта
 processed_updates: Set[int] = set()
 
@@ -61,23 +392,368 @@ banned_users: Set[int] = set()
 ban_log: Dict[int, Dict[str, Any]] = {}
 
 # лог всех пользовательских сообщений для статистики
-# каждый элемент: {"user_id": int, "timestamp": float, "type": "text"|"photo"|"video", "is_anon": bool}
+# каждый элемент: {"user_id": int, "timestamp": float, "type": content_type ("text", "photo", ...), "is_anon": bool}
 user_message_log: List[Dict[str, Any]] = []
 
+# свертка записей, вытесненных из user_message_log фоновым обслуживанием (все, что старше until)
+user_message_rollup: Dict[str, Any] = {
+    "until": 0.0,
+    "messages": 0,
+    "by_type": {"text": 0, "photo": 0, "video": 0, "other": 0},
+    "users": set(),
+    "anon_users": set(),
+}
+
+# свертка срезает начало лога, а экспорт читает его по индексу между await и в потоке:
+# читатели держат позицию как trimmed + индекс, срез и сдвиг trimmed - под lock
+user_message_log_state: Dict[str, int] = {"trimmed": 0}
+user_message_log_lock = threading.Lock()
+
 # анти-дубляж: последний отправленный в группу месседж для каждого пользователя
 # user_id -> {"chat_id": int, "message_id": int, "text": str, "time": float, "has_media": bool, "is_anon": bool}
 last_admin_message: Dict[int, Dict[str, Any]] = {}
 
 # обработанные media_group_id, чтобы не слать "спасибо" по 10 раз на альбом
-handled_media_groups: Set[str] = set()
+# media_group_id -> время первого элемента (для чистки)
+handled_media_groups: Dict[str, float] = {}
+
+# media_group_id -> (chat_id, message_id) поста с первым элементом альбома
+album_posts: Dict[str, Tuple[int, int]] = {}
+
+# теги пользователей (ключи TAG_TYPES): user_id -> {"fav", "watch", ...}
+user_tags: Dict[int, Set[str]] = {}
+
+# обратный индекс: тег -> {user_id: когда поставлен}, в порядке добавления (для /fav, /watch)
+tagged_users: Dict[str, Dict[int, float]] = {tag: {} for tag in TAG_TYPES}
+
+# хвосты альбомов, которые копируются в группу одной пачкой через copyMessages
+# media_group_id -> {"user_id": int, "admin_chat_id": int, "from_chat_id": int, "message_ids": [int, ...]}
+pending_album_copies: Dict[str, Dict[str, Any]] = {}
+
+# ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+background_tasks: Set[asyncio.Task] = set()
+
+# сколько ждать остальные элементы альбома перед пакетным копированием (сек)
+ALBUM_FLUSH_DELAY = 1.0
+
+# типы сообщений, у которых есть подпись - шапку кладем прямо в нее
+CAPTION_CONTENT_TYPES = {"photo", "video", "animation", "audio", "document", "voice"}
+
+# типы без подписи - шапку отправляем отдельным сообщением, контент копируем ответом на нее
+PLAIN_COPY_CONTENT_TYPES = {"sticker", "video_note", "location", "venue", "contact", "poll", "dice"}
+
+# как называть вложение в шапке для админов
+CONTENT_TYPE_LABELS = {
+    "photo": "с фото",
+    "video": "с видео",
+    "animation": "с GIF",
+    "audio": "с аудио",
+    "document": "с файлом",
+    "voice": "с голосовым",
+    "sticker": "со стикером",
+    "video_note": "с кружком",
+    "location": "с геопозицией",
+    "venue": "с местом",
+    "contact": "с контактом",
+    "poll": "с опросом",
+    "dice": "с кубиком",
+}
+
+
+# --- Контроль нагрузки: ступенчатая деградация при перегрузке ---
+
+LOAD_LEVEL_NORMAL = 0
+LOAD_LEVEL_SKIP_COSMETIC = 1  # не обновляем закреп со статусом и клавиатуры
+LOAD_LEVEL_DEFER = 2  # "спасибо" и прочие несрочные ответы откладываем
+LOAD_LEVEL_REJECT = 3  # отвечаем Telegram 503, он пришлет апдейт повторно
+
+LOAD_LEVEL_NAMES = {
+    LOAD_LEVEL_NORMAL: "normal",
+    LOAD_LEVEL_SKIP_COSMETIC: "skip_cosmetic",
+    LOAD_LEVEL_DEFER: "defer",
+    LOAD_LEVEL_REJECT: "reject",
+}
+
+# пороги уровней 1/2/3: апдейты в обработке и запросы к Bot API в полете
+LOAD_UPDATE_THRESHOLDS = (
+    int(os.getenv("LOAD_UPDATES_COSMETIC", "20")),
+    int(os.getenv("LOAD_UPDATES_DEFER", "50")),
+    int(os.getenv("LOAD_UPDATES_REJECT", "100")),
+)
+LOAD_OUTBOUND_THRESHOLDS = (
+    int(os.getenv("LOAD_OUTBOUND_COSMETIC", "10")),
+    int(os.getenv("LOAD_OUTBOUND_DEFER", "30")),
+    int(os.getenv("LOAD_OUTBOUND_REJECT", "60")),
+)
+
+DEFERRED_SENDS_LIMIT = 1000
+
+load_state: Dict[str, int] = {
+    "inflight_updates": 0,
+    "outbound_inflight": 0,
+    "level": LOAD_LEVEL_NORMAL,
+}
+
+# отложенные несрочные отправки: фабрики корутин, переполнение выталкивает самые старые
+deferred_sends: Deque[Callable[[], Awaitable[Any]]] = deque(maxlen=DEFERRED_SENDS_LIMIT)
+deferred_event = asyncio.Event()
+
+
+def _level_for(value: int, thresholds: Tuple[int, int, int]) -> int:
+    level = LOAD_LEVEL_NORMAL
+    for i, threshold in enumerate(thresholds, start=1):
+        if value >= threshold:
+            level = i
+    return level
+
+
+def get_load_level() -> int:
+    level = max(
+        _level_for(load_state["inflight_updates"], LOAD_UPDATE_THRESHOLDS),
+        _level_for(load_state["outbound_inflight"], LOAD_OUTBOUND_THRESHOLDS),
+    )
+    if level != load_state["level"]:
+        logging.warning(
+            "Load level %s -> %s (updates in flight: %s, API calls in flight: %s, deferred: %s)",
+            LOAD_LEVEL_NAMES[load_state["level"]],
+            LOAD_LEVEL_NAMES[level],
+            load_state["inflight_updates"],
+            load_state["outbound_inflight"],
+            len(deferred_sends),
+        )
+        load_state["level"] = level
+    return level
+
+
+@session.middleware()
+async def track_outbound_requests(make_request, bot, method):
+    load_state["outbound_inflight"] += 1
+    try:
+        return await make_request(bot, method)
+    finally:
+        load_state["outbound_inflight"] -= 1
+
+
+async def send_or_defer(factory: Callable[[], Awaitable[Any]]) -> None:
+    """Несрочная отправка: сразу, если нагрузка позволяет, иначе - в отложенную очередь."""
+    if get_load_level() >= LOAD_LEVEL_DEFER:
+        deferred_sends.append(factory)
+        deferred_event.set()
+        return
+    await factory()
+
+
+async def drain_deferred_sends() -> None:
+    while True:
+        await deferred_event.wait()
+        if not deferred_sends:
+            deferred_event.clear()
+            continue
+        if get_load_level() >= LOAD_LEVEL_DEFER:
+            await asyncio.sleep(0.5)
+            continue
+        factory = deferred_sends.popleft()
+        try:
+            await factory()
+        except Exception:
+            logging.exception("Deferred send failed")
+
+
+# --- Устойчивость к сбоям Bot API: бюджет на апдейт, ретраи, circuit breaker ---
+
+UPDATE_BUDGET = float(os.getenv("UPDATE_BUDGET", "30"))  # сек на все вызовы API одного апдейта
+API_RETRY_ATTEMPTS = 3
+API_RETRY_BASE_DELAY = 0.5
+API_RETRY_MAX_DELAY = 5.0
+BREAKER_FAILURE_THRESHOLD = 5  # подряд неудачных вызовов до размыкания
+BREAKER_COOLDOWN = 30.0  # сколько сек отказываем сразу, прежде чем пустить пробный вызов
+
+# повтор этих методов не может задублировать сообщение у пользователя
+IDEMPOTENT_METHODS = {
+    "getMe",
+    "getChat",
+    "getWebhookInfo",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageReplyMarkup",
+    "pinChatMessage",
+    "deleteWebhook",
+    "setWebhook",
+}
+
+# монотонное время, до которого должны уложиться все вызовы текущего апдейта (None - без бюджета)
+update_deadline: ContextVar[float | None] = ContextVar("update_deadline", default=None)
+
+breaker_state: Dict[str, Any] = {"failures": 0, "opened_at": None, "trial": False}
+
+
+class BotApiUnavailable(Exception):
+    """Вызов не отправлен: API считается недоступным или бюджет апдейта исчерпан."""
+
+
+def breaker_allows() -> bool:
+    opened_at = breaker_state["opened_at"]
+    if opened_at is None:
+        return True
+    if time.monotonic() - opened_at < BREAKER_COOLDOWN:
+        return False
+    # half-open: пропускаем ровно один пробный вызов
+    if breaker_state["trial"]:
+        return False
+    breaker_state["trial"] = True
+    return True
+
+
+def breaker_record(success: bool) -> None:
+    if success:
+        if breaker_state["opened_at"] is not None:
+            logging.warning("Bot API circuit closed")
+        breaker_state["failures"] = 0
+        breaker_state["opened_at"] = None
+        breaker_state["trial"] = False
+        return
+
+    breaker_state["failures"] += 1
+    if breaker_state["opened_at"] is not None:
+        # пробный вызов не прошел - снова ждем полный cooldown
+        breaker_state["opened_at"] = time.monotonic()
+        breaker_state["trial"] = False
+    elif breaker_state["failures"] >= BREAKER_FAILURE_THRESHOLD:
+        logging.warning(
+            "Bot API circuit opened after %s consecutive failures", breaker_state["failures"]
+        )
+        breaker_state["opened_at"] = time.monotonic()
+
+
+def is_transient_api_error(error: BaseException) -> bool:
+    return isinstance(
+        error,
+        (BotApiUnavailable, TelegramNetworkError, TelegramServerError, TelegramRetryAfter, asyncio.TimeoutError),
+    )
+
+
+def is_unsent_api_error(error: BaseException) -> bool:
+    # запрос точно не выполнен: до Telegram не дошел или отбит флуд-контролем.
+    # Таймаут, сетевая и 5xx ошибки сюда не входят - запрос мог и выполниться
+    return isinstance(error, (BotApiUnavailable, TelegramRetryAfter))
+
+
+@session.middleware()
+async def resilient_requests(make_request, bot, method):
+    name = method.__api_method__
+    attempt = 0
 
-# теги пользователей: избранный / под наблюдением
-# user_id -> {"fav": bool, "watch": bool}
-user_tags: Dict[int, Dict[str, bool]] = {}
+    while True:
+        if not breaker_allows():
+            raise BotApiUnavailable(f"Bot API circuit is open, {name} not sent")
+        # цепь открыта, но вызов пропущен - это единственный пробный вызов half-open
+        is_trial = breaker_state["opened_at"] is not None
+
+        deadline = update_deadline.get()
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise BotApiUnavailable(f"Update time budget exhausted before {name}")
+
+        try:
+            return_value = await asyncio.wait_for(make_request(bot, method), timeout)
+        except TelegramRetryAfter as e:
+            # флуд-контроль: запрос точно не выполнен, повтор безопасен для любого метода;
+            # ответ флуд-контроля - тоже ответ, API живой
+            breaker_record(True)
+            error: BaseException = e
+            retryable = True
+            delay = float(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+            breaker_record(False)
+            error = e
+            retryable = name in IDEMPOTENT_METHODS
+            # full jitter: клиенты не долбят API синхронными волнами
+            delay = random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2 ** attempt))
+        except TelegramAPIError:
+            # API ответил (пусть и ошибкой) - значит, живой
+            breaker_record(True)
+            raise
+        else:
+            breaker_record(True)
+            return return_value
+        finally:
+            # отмена или неожиданная ошибка пробного вызова не должны оставить цепь
+            # в half-open навсегда: следующий вызов после cooldown снова будет пробным
+            if is_trial:
+                breaker_state["trial"] = False
+
+        attempt += 1
+        if not retryable or attempt >= API_RETRY_ATTEMPTS:
+            raise error
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            raise error
+        logging.warning("Retrying %s in %.1fs after %r", name, delay, error)
+        await asyncio.sleep(delay)
+
+
+# --- Параллельные вызовы Bot API внутри одного хендлера ---
+
+
+class CallScope:
+    """Область, в которой независимые вызовы Bot API идут одновременно.
+
+    Выход из `async with` ждет все запущенные вызовы; первая ошибка
+    пробрасывается дальше (остальные пишутся в лог), как при обычных await.
+    Вызовы, которые должны идти строго по порядку, просто await-ятся внутри.
+    """
+
+    def __init__(self) -> None:
+        self.tasks: List[asyncio.Future] = []
+
+    def start(self, aw: Awaitable[Any]) -> asyncio.Future:
+        task = asyncio.ensure_future(aw)
+        self.tasks.append(task)
+        return task
+
+    async def __aenter__(self) -> "CallScope":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        results = await asyncio.gather(*self.tasks, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if exc is not None:
+            for error in errors:
+                logging.error("Concurrent Bot API call failed", exc_info=error)
+            return False
+        if errors:
+            for error in errors[1:]:
+                logging.error("Concurrent Bot API call failed", exc_info=error)
+            raise errors[0]
+        return False
+
+
+async def run_concurrently(*aws: Awaitable[Any]) -> List[Any]:
+    async with CallScope() as scope:
+        tasks = [scope.start(aw) for aw in aws]
+    return [task.result() for task in tasks]
+
+
+async def quietly(aw: Awaitable[Any]) -> Any:
+    # для необязательных вызовов: "message is not modified" и т.п. ожидаемы,
+    # а вот сбои API пишем в лог, а не глушим молча
+    try:
+        return await aw
+    except TelegramBadRequest:
+        return None
+    except Exception:
+        logging.warning("Optional Bot API call failed", exc_info=True)
+        return None
 
 
 # --- Вспомогательные функции ---
 
+def token_matches(token: str, expected: str) -> bool:
+    # compare_digest на str падает с TypeError на не-ASCII, а заголовок присылает кто угодно
+    return secrets.compare_digest(token.encode(), expected.encode())
+
+
 def get_user_settings(user_id: int) -> Dict[str, Any]:
     if user_id not in user_settings:
         user_settings[user_id] = {
@@ -96,10 +772,38 @@ def is_anon(user_id: int) -> bool:
     return bool(get_user_settings(user_id).get("anon", False))
 
 
-def get_user_tags(user_id: int) -> Dict[str, bool]:
-    if user_id not in user_tags:
-        user_tags[user_id] = {"fav": False, "watch": False}
-    return user_tags[user_id]
+def has_tag(user_id: int, tag: str) -> bool:
+    return user_id in tagged_users[tag]
+
+
+def set_user_tag(user_id: int, tag: str, on: bool) -> None:
+    tags = user_tags.setdefault(user_id, set())
+    if on:
+        tags.add(tag)
+        tagged_users[tag].setdefault(user_id, time.time())
+    else:
+        tags.discard(tag)
+        tagged_users[tag].pop(user_id, None)
+    if not tags:
+        del user_tags[user_id]
+
+
+def pick_admin_chat(user_id: int) -> int:
+    """В какую админ-группу слать сообщения пользователя."""
+    for tag, chat_id in ADMIN_TAG_CHATS.items():
+        if user_id in tagged_users[tag]:
+            return chat_id
+
+    if len(ADMIN_CHAT_POOL) == 1:
+        return ADMIN_CHAT_POOL[0]
+
+    # rendezvous hashing: при добавлении группы переезжает только ее доля пользователей
+    return max(
+        ADMIN_CHAT_POOL,
+        key=lambda chat_id: hashlib.blake2b(
+            f"{chat_id}:{user_id}".encode(), digest_size=8
+        ).digest(),
+    )
 
 
 def format_user_info(user: types.User) -> str:
@@ -110,44 +814,60 @@ def format_user_info(user: types.User) -> str:
     return text
 
 
-def make_ban_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    tags = get_user_tags(user_id)
-    fav = tags["fav"]
-    watch = tags["watch"]
+def build_admin_message_text(
+    user: types.User,
+    anon: bool,
+    kind: str,
+    body: str | None,
+) -> str:
+    """Шапка сообщения для админ-группы; body=None - вложение без подписи."""
+    label = CONTENT_TYPE_LABELS.get(kind)
+    if anon:
+        title = f"Новое анонимное сообщение {label}" if label else "Новое анонимное сообщение"
+        text = f"📩 <b>{title}</b>"
+    else:
+        if label:
+            title = f"Новое сообщение {label} от пользователя"
+        else:
+            title = "Новое сообщение от пользователя"
+        text = f"📩 <b>{title}</b>\n\n{format_user_info(user)}"
+
+    if body is None:
+        return text
 
-    fav_text = "⭐ Избранное" if not fav else "⭐ Убрать"
-    watch_text = "👁 Наблюдение" if not watch else "👁 Убрать"
+    body_title = "Текст" if kind == "text" else "Подпись"
+    return text + f"\n\n💬 <b>{body_title}:</b>\n{body}"
 
+
+def make_tag_buttons(user_id: int) -> List[InlineKeyboardButton]:
+    return [
+        InlineKeyboardButton(
+            text=f"{info['icon']} Убрать" if has_tag(user_id, tag) else f"{info['icon']} {info['button']}",
+            callback_data=f"tag:{tag}:{user_id}",
+        )
+        for tag, info in TAG_TYPES.items()
+    ]
+
+
+def make_ban_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
                 InlineKeyboardButton(
                     text="🚫 Заблокировать",
                     callback_data=f"ban:{user_id}",
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text=fav_text,
-                    callback_data=f"tag:fav:{user_id}",
                 ),
                 InlineKeyboardButton(
-                    text=watch_text,
-                    callback_data=f"tag:watch:{user_id}",
+                    text="📜 История",
+                    callback_data=f"history:{user_id}",
                 ),
             ],
+            make_tag_buttons(user_id),
         ]
     )
 
 
 def make_unban_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    tags = get_user_tags(user_id)
-    fav = tags["fav"]
-    watch = tags["watch"]
-
-    fav_text = "⭐ Избранное" if not fav else "⭐ Убрать"
-    watch_text = "👁 Наблюдение" if not watch else "👁 Убрать"
-
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
@@ -156,16 +876,7 @@ def make_unban_keyboard(user_id: int) -> InlineKeyboardMarkup:
                     callback_data=f"unban:{user_id}",
                 )
             ],
-            [
-                InlineKeyboardButton(
-                    text=fav_text,
-                    callback_data=f"tag:fav:{user_id}",
-                ),
-                InlineKeyboardButton(
-                    text=watch_text,
-                    callback_data=f"tag:watch:{user_id}",
-                ),
-            ],
+            make_tag_buttons(user_id),
         ]
     )
 
@@ -189,6 +900,10 @@ async def ensure_status_message(user_id: int) -> None:
 
     text = build_status_text(lang, anon)
 
+    # закреп со статусом - косметика, под нагрузкой его не трогаем
+    if get_load_level() >= LOAD_LEVEL_SKIP_COSMETIC:
+        return
+
     if status_msg_id:
         try:
             await bot.edit_message_text(
@@ -197,18 +912,25 @@ async def ensure_status_message(user_id: int) -> None:
                 text=text,
             )
             return
-        except Exception:
-            pass
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            # старый статус удален или недоступен - присылаем новый
 
     msg = await bot.send_message(chat_id=user_id, text=text)
-    try:
-        await bot.pin_chat_message(chat_id=user_id, message_id=msg.message_id)
-    except Exception:
-        pass
     settings["status_msg_id"] = msg.message_id
+    await quietly(bot.pin_chat_message(chat_id=user_id, message_id=msg.message_id))
+
+
+def custom_text(name: str, lang: str) -> str | None:
+    # тексты из BOT_TEXTS перекрывают встроенные: {"start": {"ru": "...", "en": "..."}, ...}
+    return BOT_TEXTS.get(name, {}).get(lang)
 
 
 def build_start_text(lang: str) -> str:
+    custom = custom_text("start", lang)
+    if custom:
+        return custom
     if lang == "en":
         return (
             "Hi! 👋\n\n"
@@ -217,7 +939,7 @@ def build_start_text(lang: str) -> str:
             "• ask a question\n"
             "• share your opinion\n"
             "• send an idea or suggestion\n\n"
-            "You can send a message as text, photo or video. "
+            "You can send text, photos, videos, voice messages, files and other content. "
             "Admins will read it and, if necessary, reply to you.\n\n"
             "You can enable anonymous mode so that admins do not see your data. "
             "Use the button below or the /anon command.\n"
@@ -231,7 +953,7 @@ def build_start_text(lang: str) -> str:
             "• задать вопрос\n"
             "• поделиться мнением\n"
             "• отправить идею или предложение\n\n"
-            "Вы можете отправлять текст, фотографии и видео. "
+            "Вы можете отправлять текст, фото, видео, голосовые, файлы и другие сообщения. "
             "Админы всё прочитают и при необходимости ответят вам.\n\n"
             "Вы можете включить анонимный режим, чтобы админы не видели ваши данные. "
             "Используйте кнопку ниже или команду /anon.\n"
@@ -240,6 +962,9 @@ def build_start_text(lang: str) -> str:
 
 
 def build_thanks_text(lang: str) -> str:
+    custom = custom_text("thanks", lang)
+    if custom:
+        return custom
     if lang == "en":
         return "Thank you, your message has been sent ✅"
     else:
@@ -247,6 +972,9 @@ def build_thanks_text(lang: str) -> str:
 
 
 def build_blocked_text(lang: str) -> str:
+    custom = custom_text("blocked", lang)
+    if custom:
+        return custom
     if lang == "en":
         return "You have been blocked and can no longer use this bot."
     else:
@@ -254,13 +982,19 @@ def build_blocked_text(lang: str) -> str:
 
 
 def build_unsupported_text(lang: str) -> str:
+    custom = custom_text("unsupported", lang)
+    if custom:
+        return custom
     if lang == "en":
-        return "Right now I only support text messages, photos and videos."
+        return "Sorry, this type of message can't be delivered to the admins."
     else:
-        return "Пока я принимаю только текстовые сообщения, фотографии и видео."
+        return "К сожалению, такой тип сообщения нельзя передать админам."
 
 
 def build_anon_on_text(lang: str) -> str:
+    custom = custom_text("anon_on", lang)
+    if custom:
+        return custom
     if lang == "en":
         return "Anonymous mode is now ON. Your next messages will be sent anonymously."
     else:
@@ -268,6 +1002,9 @@ def build_anon_on_text(lang: str) -> str:
 
 
 def build_anon_off_text(lang: str) -> str:
+    custom = custom_text("anon_off", lang)
+    if custom:
+        return custom
     if lang == "en":
         return "Anonymous mode is now OFF. Your future messages will be sent with your data."
     else:
@@ -359,13 +1096,14 @@ async def cmd_start(message: types.Message):
     lang = settings["lang"]
     anon = settings["anon"]
 
-    await message.answer(
-        build_start_text(lang),
-        reply_markup=make_start_keyboard(lang, anon),
+    await run_concurrently(
+        message.answer(
+            build_start_text(lang),
+            reply_markup=make_start_keyboard(lang, anon),
+        ),
+        ensure_status_message(user_id),
     )
 
-    await ensure_status_message(user_id)
-
 
 # --- Callback: смена языка и анонимности (кнопки под стартовым) ---
 
@@ -377,19 +1115,22 @@ async def cb_toggle_anon(callback: types.CallbackQuery):
     settings["anon"] = not settings.get("anon", False)
     lang = settings["lang"]
 
-    await ensure_status_message(user_id)
-
-    try:
-        await callback.message.edit_reply_markup(
-            reply_markup=make_start_keyboard(lang, settings["anon"])
+    async with CallScope() as scope:
+        scope.start(ensure_status_message(user_id))
+        if get_load_level() < LOAD_LEVEL_SKIP_COSMETIC:
+            scope.start(
+                quietly(
+                    callback.message.edit_reply_markup(
+                        reply_markup=make_start_keyboard(lang, settings["anon"])
+                    )
+                )
+            )
+        scope.start(
+            callback.answer(
+                build_anon_on_text(lang) if settings["anon"] else build_anon_off_text(lang),
+                show_alert=False,
+            )
         )
-    except Exception:
-        pass
-
-    await callback.answer(
-        build_anon_on_text(lang) if settings["anon"] else build_anon_off_text(lang),
-        show_alert=False,
-    )
 
 
 @dp.callback_query(F.message.chat.type == "private", F.data.startswith("lang:"))
@@ -405,26 +1146,31 @@ async def cb_set_lang(callback: types.CallbackQuery):
     settings["lang"] = lang_code
     lang = settings["lang"]
 
-    await ensure_status_message(user_id)
-
     # меняем и текст приветствия, и клавиатуру
-    try:
-        await callback.message.edit_text(
-            build_start_text(lang),
-            reply_markup=make_start_keyboard(lang, settings["anon"]),
-        )
-    except Exception:
+    async def update_start_message():
         try:
-            await callback.message.edit_reply_markup(
-                reply_markup=make_start_keyboard(lang, settings["anon"])
+            await callback.message.edit_text(
+                build_start_text(lang),
+                reply_markup=make_start_keyboard(lang, settings["anon"]),
             )
         except Exception:
-            pass
+            try:
+                await callback.message.edit_reply_markup(
+                    reply_markup=make_start_keyboard(lang, settings["anon"])
+                )
+            except Exception:
+                pass
 
     if lang == "en":
-        await callback.answer("Language switched to English", show_alert=False)
+        answer_text = "Language switched to English"
     else:
-        await callback.answer("Язык переключен на русский", show_alert=False)
+        answer_text = "Язык переключен на русский"
+
+    await run_concurrently(
+        ensure_status_message(user_id),
+        update_start_message(),
+        callback.answer(answer_text, show_alert=False),
+    )
 
 
 # --- /anon в личке ---
@@ -440,22 +1186,29 @@ async def cmd_anon(message: types.Message):
 
     if len(parts) == 1:
         settings["anon"] = not settings["anon"]
-        await ensure_status_message(user_id)
         if settings["anon"]:
-            await message.answer(build_anon_on_text(lang))
+            answer_text = build_anon_on_text(lang)
         else:
-            await message.answer(build_anon_off_text(lang))
+            answer_text = build_anon_off_text(lang)
+        await run_concurrently(
+            ensure_status_message(user_id),
+            message.answer(answer_text),
+        )
         return
 
     arg = parts[1].strip().lower()
     if arg in ("on", "вкл", "on.", "включить"):
         settings["anon"] = True
-        await ensure_status_message(user_id)
-        await message.answer(build_anon_on_text(lang))
+        await run_concurrently(
+            ensure_status_message(user_id),
+            message.answer(build_anon_on_text(lang)),
+        )
     elif arg in ("off", "выкл", "выключить"):
         settings["anon"] = False
-        await ensure_status_message(user_id)
-        await message.answer(build_anon_off_text(lang))
+        await run_concurrently(
+            ensure_status_message(user_id),
+            message.answer(build_anon_off_text(lang)),
+        )
     else:
         if lang == "en":
             await message.answer(
@@ -476,7 +1229,7 @@ async def cmd_anon(message: types.Message):
 # --- Панель админа ---
 
 
-@dp.message(F.chat.id == ADMIN_CHAT_ID, F.text == "/panel")
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text == "/panel")
 async def cmd_panel(message: types.Message):
     await message.reply(
         "Панель управления:",
@@ -484,22 +1237,718 @@ async def cmd_panel(message: types.Message):
     )
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("panel:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("panel:"))
 async def handle_panel_callback(callback: types.CallbackQuery):
     _, action = callback.data.split(":", 1)
 
     if action == "stats":
-        await cmd_stats(callback.message)
-        await callback.answer()
+        await run_concurrently(cmd_stats(callback.message), callback.answer())
     elif action == "bans":
-        await cmd_bans(callback.message)
-        await callback.answer()
+        await run_concurrently(cmd_bans(callback.message), callback.answer())
     elif action == "new":
-        await callback.answer("Функция очереди пока не реализована.", show_alert=True)
+        await run_concurrently(cmd_inbox(callback.message), callback.answer())
     else:
         await callback.answer("Неизвестная команда панели.", show_alert=True)
 
 
+# --- Пакетное копирование альбомов ---
+
+
+def spawn_background(coro) -> asyncio.Task:
+    # фоновая работа живет дольше апдейта - бюджет времени апдейта на нее не распространяется
+    ctx = contextvars.copy_context()
+    ctx.run(update_deadline.set, None)
+    # create_task(context=...) есть только с Python 3.11; задача копирует текущий контекст
+    task = ctx.run(asyncio.create_task, coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def queue_album_copy(media_group_id: str, user_id: int, from_chat_id: int, message_id: int) -> None:
+    entry = pending_album_copies.get(media_group_id)
+    if entry is None:
+        entry = {
+            "user_id": user_id,
+            "admin_chat_id": pick_admin_chat(user_id),
+            "from_chat_id": from_chat_id,
+            "message_ids": [],
+        }
+        pending_album_copies[media_group_id] = entry
+        spawn_background(flush_album_copies(media_group_id))
+    entry["message_ids"].append(message_id)
+
+
+async def flush_album_copies(media_group_id: str) -> None:
+    # Telegram присылает элементы альбома отдельными апдейтами почти одновременно -
+    # немного ждем и отправляем их в группу одним вызовом copyMessages
+    await asyncio.sleep(ALBUM_FLUSH_DELAY)
+    entry = pending_album_copies.pop(media_group_id, None)
+    if not entry:
+        return
+
+    try:
+        copied = await bot.copy_messages(
+            chat_id=entry["admin_chat_id"],
+            from_chat_id=entry["from_chat_id"],
+            message_ids=sorted(entry["message_ids"]),
+        )
+    except Exception:
+        logging.exception("Failed to copy album %s to admin chat", media_group_id)
+        return
+
+    root = album_posts.get(media_group_id)
+    for msg_id in copied:
+        key = (entry["admin_chat_id"], msg_id.message_id)
+        message_targets[key] = entry["user_id"]
+        if root is not None:
+            message_roots[key] = root
+
+
+# --- Защита от флуда одинаковыми сообщениями от разных пользователей ---
+
+FLOOD_WINDOW = 10 * 60  # сколько помним уже пересланный контент (сек)
+FLOOD_MAX_CLUSTERS = 10000
+FLOOD_MIN_TEXT_LEN = 20  # короткие "привет" у разных людей совпадают законно
+FLOOD_MAX_DISTANCE = 7  # допустимое расстояние Хэмминга между simhash
+FLOOD_BANDS = 8  # 64 бита режем на 8 полос по 8: при расстоянии <= 7 одна полоса совпадет
+FLOOD_EDIT_INTERVAL = 5.0  # счетчик в админ-группе обновляем не чаще (сек)
+
+flood_cluster_ids = itertools.count(1)
+
+# cluster_id -> {"exact": str|None, "simhash": int|None, "chat_id": int, "message_id": int,
+#                "user_id": int, "has_media": bool, "text": str, "count": int, "users": set,
+#                "last_seen": float, "edit_pending": bool}
+# text - текущий текст/подпись поста без счетчика: правим пост по (chat_id, message_id),
+# не завися от того, что пользователь с тех пор писал еще
+# порядок = порядок последнего появления, старые выталкиваются с начала
+flood_clusters: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+
+# file_unique_id медиа -> cluster_id
+flood_exact_index: Dict[str, int] = {}
+
+# (номер полосы, значение полосы simhash) -> cluster_id
+flood_band_index: Dict[Tuple[int, int], Set[int]] = {}
+
+# (chat_id, message_id) поста в админ-группе -> cluster_id
+flood_by_message: Dict[Tuple[int, int], int] = {}
+
+
+def normalize_flood_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"https?://\S+", " ", text)
+    text = re.sub(r"[\W_]+", " ", text)
+    return " ".join(text.split())
+
+
+def simhash(text: str) -> int:
+    tokens = text.split()
+    # шинглы по 2 слова устойчивее к перестановкам отдельных слов, чем просто слова
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    weights = [0] * 64
+    for feature in features:
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    value = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    return value
+
+
+def simhash_bands(value: int) -> List[Tuple[int, int]]:
+    width = 64 // FLOOD_BANDS
+    mask = (1 << width) - 1
+    return [(band, (value >> (band * width)) & mask) for band in range(FLOOD_BANDS)]
+
+
+def build_flood_keys(message: types.Message) -> Dict[str, Any] | None:
+    if message.photo:
+        return {"exact": f"photo:{message.photo[-1].file_unique_id}", "simhash": None}
+    if message.video:
+        return {"exact": f"video:{message.video.file_unique_id}", "simhash": None}
+    if message.text:
+        normalized = normalize_flood_text(message.text)
+        if len(normalized) >= FLOOD_MIN_TEXT_LEN:
+            return {"exact": None, "simhash": simhash(normalized)}
+    return None
+
+
+def drop_flood_cluster(cluster_id: int) -> None:
+    cluster = flood_clusters.pop(cluster_id, None)
+    if cluster is None:
+        return
+    if cluster["exact"]:
+        flood_exact_index.pop(cluster["exact"], None)
+    if cluster["simhash"] is not None:
+        for band in simhash_bands(cluster["simhash"]):
+            ids = flood_band_index.get(band)
+            if ids is not None:
+                ids.discard(cluster_id)
+                if not ids:
+                    del flood_band_index[band]
+    flood_by_message.pop((cluster["chat_id"], cluster["message_id"]), None)
+
+
+def evict_flood_clusters(now: float) -> None:
+    while flood_clusters:
+        cluster_id, cluster = next(iter(flood_clusters.items()))
+        if cluster["last_seen"] >= now - FLOOD_WINDOW and len(flood_clusters) <= FLOOD_MAX_CLUSTERS:
+            break
+        drop_flood_cluster(cluster_id)
+
+
+def find_flood_cluster(keys: Dict[str, Any]) -> int | None:
+    if keys["exact"]:
+        return flood_exact_index.get(keys["exact"])
+
+    value = keys["simhash"]
+    candidates: Set[int] = set()
+    for band in simhash_bands(value):
+        candidates |= flood_band_index.get(band, set())
+    for cluster_id in candidates:
+        if bin(flood_clusters[cluster_id]["simhash"] ^ value).count("1") <= FLOOD_MAX_DISTANCE:
+            return cluster_id
+    return None
+
+
+def register_flood_cluster(
+    keys: Dict[str, Any],
+    chat_id: int,
+    message_id: int,
+    user_id: int,
+    has_media: bool,
+    text: str,
+) -> None:
+    now = time.time()
+    evict_flood_clusters(now)
+
+    cluster_id = next(flood_cluster_ids)
+    flood_clusters[cluster_id] = {
+        "exact": keys["exact"],
+        "simhash": keys["simhash"],
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "user_id": user_id,
+        "has_media": has_media,
+        "text": text,
+        "count": 0,
+        "users": set(),
+        "last_seen": now,
+        "edit_pending": False,
+    }
+    if keys["exact"]:
+        flood_exact_index[keys["exact"]] = cluster_id
+    else:
+        for band in simhash_bands(keys["simhash"]):
+            flood_band_index.setdefault(band, set()).add(cluster_id)
+    flood_by_message[(chat_id, message_id)] = cluster_id
+
+
+def flood_suffix(chat_id: int, message_id: int) -> str:
+    cluster_id = flood_by_message.get((chat_id, message_id))
+    if cluster_id is None:
+        return ""
+    cluster = flood_clusters[cluster_id]
+    if not cluster["count"]:
+        return ""
+    return (
+        f"\n\n🔁 <b>Повторы:</b> {cluster['count']} "
+        f"(от {len(cluster['users'])} польз.)"
+    )
+
+
+def fold_flood_repeat(keys: Dict[str, Any], user_id: int) -> bool:
+    """Повтор уже пересланного контента: вместо нового поста увеличиваем счетчик."""
+    now = time.time()
+    evict_flood_clusters(now)
+
+    cluster_id = find_flood_cluster(keys)
+    if cluster_id is None:
+        return False
+
+    cluster = flood_clusters[cluster_id]
+    cluster["count"] += 1
+    cluster["users"].add(user_id)
+    cluster["last_seen"] = now
+    flood_clusters.move_to_end(cluster_id)
+
+    if not cluster["edit_pending"]:
+        cluster["edit_pending"] = True
+        spawn_background(flush_flood_counter(cluster_id))
+    return True
+
+
+async def flush_flood_counter(cluster_id: int) -> None:
+    # за интервал может набежать сотня повторов - в группу уходит одна правка
+    await asyncio.sleep(FLOOD_EDIT_INTERVAL)
+    cluster = flood_clusters.get(cluster_id)
+    if cluster is None:
+        return
+    cluster["edit_pending"] = False
+
+    chat_id = cluster["chat_id"]
+    message_id = cluster["message_id"]
+    orig_user_id = cluster["user_id"]
+    new_text = cluster["text"] + flood_suffix(chat_id, message_id)
+
+    if orig_user_id in banned_users:
+        kb = make_unban_keyboard(orig_user_id)
+    else:
+        kb = make_ban_keyboard(orig_user_id)
+
+    try:
+        if cluster["has_media"]:
+            await bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=message_id,
+                caption=new_text,
+                reply_markup=kb,
+            )
+        else:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=new_text,
+                reply_markup=kb,
+            )
+    except TelegramBadRequest as e:
+        if "not modified" in str(e):
+            return
+        # пост удален или его больше нельзя править - дальнейшие повторы пересылаем как обычно
+        logging.warning("Flood post %s is no longer editable: %s", message_id, e)
+        drop_flood_cluster(cluster_id)
+    except Exception:
+        logging.exception("Failed to update flood counter for message %s", message_id)
+
+
+# --- Очередь неотвеченных сообщений для панели админа ---
+
+INBOX_PAGE_SIZE = 10
+INBOX_PREVIEW_LEN = 60
+
+
+class SortedKeyList:
+    """Отсортированный список из блоков (как в sortedcontainers).
+
+    Вставка и удаление - бинарный поиск по максимумам блоков и сдвиг внутри
+    одного блока, т.е. O(log n) плюс небольшая константа; срез для страницы -
+    проход по длинам блоков.
+    """
+
+    BLOCK = 256
+
+    def __init__(self) -> None:
+        self.blocks: List[List[Any]] = []
+        self.maxes: List[Any] = []
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, item: Any) -> None:
+        if not self.blocks:
+            self.blocks.append([item])
+            self.maxes.append(item)
+            self.size = 1
+            return
+
+        i = bisect.bisect_left(self.maxes, item)
+        if i == len(self.maxes):
+            i -= 1
+            self.blocks[i].append(item)
+            self.maxes[i] = item
+        else:
+            bisect.insort(self.blocks[i], item)
+        self.size += 1
+
+        block = self.blocks[i]
+        if len(block) > 2 * self.BLOCK:
+            self.blocks[i:i + 1] = [block[:self.BLOCK], block[self.BLOCK:]]
+            self.maxes[i:i + 1] = [block[self.BLOCK - 1], block[-1]]
+
+    def remove(self, item: Any) -> bool:
+        i = bisect.bisect_left(self.maxes, item)
+        if i == len(self.maxes):
+            return False
+        block = self.blocks[i]
+        j = bisect.bisect_left(block, item)
+        if j == len(block) or block[j] != item:
+            return False
+
+        del block[j]
+        self.size -= 1
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+        return True
+
+    def slice(self, start: int, stop: int) -> List[Any]:
+        result: List[Any] = []
+        for block in self.blocks:
+            if start >= len(block):
+                start -= len(block)
+                stop -= len(block)
+                continue
+            result.extend(block[start:stop])
+            stop -= len(block)
+            start = 0
+            if stop <= 0:
+                break
+        return result
+
+
+# ключ сообщения в очереди: (chat_id, message_id поста, part); part = 0 у обычного поста,
+# у записей дайджеста - номер записи в посте (1, 2, ...)
+InboxKey = Tuple[int, int, int]
+
+# admin chat_id -> отсортированные (score, chat_id, message_id, part)
+inbox_queues: Dict[int, SortedKeyList] = {}
+
+# ключ -> {"user_id": int, "forwarded_at": float, "score": float, "is_anon": bool, "preview": str}
+inbox_items: Dict[InboxKey, Dict[str, Any]] = {}
+
+# user_id -> ключи его неотвеченных сообщений (для смены приоритета и очистки)
+inbox_by_user: Dict[int, Set[InboxKey]] = {}
+
+
+def inbox_score(user_id: int, forwarded_at: float) -> float:
+    # теги с boost (TAG_TYPES) поднимают сообщение выше в очереди
+    boost = max((TAG_TYPES[tag]["boost"] for tag in user_tags.get(user_id, ())), default=0)
+    return forwarded_at - boost
+
+
+def inbox_add(
+    chat_id: int,
+    message_id: int,
+    user_id: int,
+    forwarded_at: float,
+    is_anon: bool,
+    preview: str,
+    part: int = 0,
+) -> None:
+    key = (chat_id, message_id, part)
+    if key in inbox_items:
+        # дополнение к уже пересланному сообщению: ждет столько же, сколько и оно
+        return
+    score = inbox_score(user_id, forwarded_at)
+    inbox_items[key] = {
+        "user_id": user_id,
+        "forwarded_at": forwarded_at,
+        "score": score,
+        "is_anon": is_anon,
+        "preview": preview[:INBOX_PREVIEW_LEN],
+    }
+    inbox_by_user.setdefault(user_id, set()).add(key)
+    inbox_queues.setdefault(chat_id, SortedKeyList()).add((score, *key))
+
+
+def inbox_remove(key: InboxKey) -> bool:
+    item = inbox_items.pop(key, None)
+    if item is None:
+        return False
+    inbox_queues[key[0]].remove((item["score"], *key))
+    keys = inbox_by_user.get(item["user_id"])
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del inbox_by_user[item["user_id"]]
+    return True
+
+
+def inbox_mark_answered(user_id: int, chat_id: int, message_id: int) -> None:
+    # ответ на пост закрывает его (у дайджеста - все записи пользователя в нем)
+    # и все более ранние сообщения этого пользователя
+    keys = inbox_by_user.get(user_id, ())
+    answered = [inbox_items[key]["forwarded_at"] for key in keys if key[:2] == (chat_id, message_id)]
+    if not answered:
+        return
+    latest = max(answered)
+    for other in list(keys):
+        if inbox_items[other]["forwarded_at"] <= latest:
+            inbox_remove(other)
+
+
+def inbox_clear_user(user_id: int) -> None:
+    for key in list(inbox_by_user.get(user_id, ())):
+        inbox_remove(key)
+
+
+def inbox_reprioritize_user(user_id: int) -> None:
+    for key in inbox_by_user.get(user_id, ()):
+        item = inbox_items[key]
+        queue_ = inbox_queues[key[0]]
+        queue_.remove((item["score"], *key))
+        item["score"] = inbox_score(user_id, item["forwarded_at"])
+        queue_.add((item["score"], *key))
+
+
+def build_inbox_page(chat_id: int, page: int) -> Tuple[str, InlineKeyboardMarkup | None]:
+    queue_ = inbox_queues.get(chat_id)
+    total = len(queue_) if queue_ else 0
+    if not total:
+        return "📥 Неотвеченных сообщений нет.", None
+
+    pages = (total + INBOX_PAGE_SIZE - 1) // INBOX_PAGE_SIZE
+    page = min(page, pages - 1)
+    start = page * INBOX_PAGE_SIZE
+    now = time.time()
+
+    lines = [f"📥 <b>Неотвеченные сообщения:</b> {total} (стр. {page + 1}/{pages})"]
+    for i, (_, msg_chat_id, message_id, part) in enumerate(
+        queue_.slice(start, start + INBOX_PAGE_SIZE), start=start + 1
+    ):
+        item = inbox_items[(msg_chat_id, message_id, part)]
+        marks = "".join(
+            info["icon"] for tag, info in TAG_TYPES.items() if has_tag(item["user_id"], tag)
+        )
+        who = "аноним" if item["is_anon"] else f"<code>{item['user_id']}</code>"
+        waiting = format_duration(now - item["forwarded_at"])
+        link = build_message_link(msg_chat_id, message_id)
+        head = f'<a href="{link}">ждет {waiting}</a>' if link else f"ждет {waiting}"
+        if part:
+            head += f" · дайджест №{part}"
+        preview = html.escape(item["preview"]) or "[вложение]"
+        lines.append(f"\n{i}) {marks}{' ' if marks else ''}{head} · {who}\n{preview}")
+
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"inbox:{page - 1}"))
+    row.append(InlineKeyboardButton(text="🔄", callback_data=f"inbox:{page}"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton(text="Дальше ➡️", callback_data=f"inbox:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[row])
+
+
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text == "/inbox")
+async def cmd_inbox(message: types.Message):
+    text, kb = build_inbox_page(message.chat.id, 0)
+    await message.reply(text, reply_markup=kb, disable_web_page_preview=True)
+
+
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("inbox:"))
+async def handle_inbox_callback(callback: types.CallbackQuery):
+    data = callback.data or ""
+    try:
+        _, page_str = data.split(":", 1)
+        page = max(int(page_str), 0)
+    except Exception:
+        await callback.answer("Ошибка при выборе страницы.", show_alert=True)
+        return
+
+    text, kb = build_inbox_page(callback.message.chat.id, page)
+    await run_concurrently(
+        quietly(callback.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)),
+        callback.answer(),
+    )
+
+
+# --- Дайджест: тексты обычных пользователей одним постом раз в интервал ---
+
+# off - выключен; always - всегда; load - только пока нагрузка выше нормы
+DIGEST_MODE = os.getenv("DIGEST_MODE", "off").lower()
+DIGEST_INTERVAL = float(os.getenv("DIGEST_INTERVAL", "60"))  # сек между дайджестами
+DIGEST_MAX_ENTRIES = 10  # записей в одном посте, по кнопке на каждую
+DIGEST_ENTRY_LEN = 300  # длиннее - обрезаем, полный текст будет в карточке
+DIGEST_MAX_POST_LEN = 3800  # лимит Telegram 4096 символов, с запасом на разметку
+DIGEST_POSTS_KEPT = 1000  # по скольким последним постам помним записи для кнопок
+# больше записей в очереди одного чата не копим: если дайджест долго не уходит,
+# новые сообщения идут обычными постами, а не растят память
+DIGEST_MAX_PENDING = 1000
+
+if DIGEST_MODE not in ("off", "always", "load"):
+    raise RuntimeError("DIGEST_MODE must be 'off', 'always' or 'load'")
+
+# admin chat_id -> записи до следующего дайджеста
+# каждая запись: {"user": types.User, "anon": bool, "text": str, "ts": float, "card_id": int|None}
+digest_pending: Dict[int, List[Dict[str, Any]]] = {}
+
+# (chat_id, message_id) поста-дайджеста -> его записи, по порядку кнопок
+digest_posts: "OrderedDict[Tuple[int, int], List[Dict[str, Any]]]" = OrderedDict()
+
+
+def digest_applies(admin_chat_id: int, user_id: int) -> bool:
+    if DIGEST_MODE == "off":
+        return False
+    if DIGEST_MODE == "load" and get_load_level() < LOAD_LEVEL_SKIP_COSMETIC:
+        return False
+    if len(digest_pending.get(admin_chat_id, ())) >= DIGEST_MAX_PENDING:
+        return False
+    # избранные и наблюдаемые всегда приходят отдельным постом сразу
+    return not any(
+        info["immediate"] and user_id in tagged_users[tag] for tag, info in TAG_TYPES.items()
+    )
+
+
+def queue_digest_entry(admin_chat_id: int, user: types.User, anon: bool, text: str) -> None:
+    digest_pending.setdefault(admin_chat_id, []).append(
+        {"user": user, "anon": anon, "text": text, "ts": time.time(), "card_id": None}
+    )
+
+
+def format_digest_entry(index: int, entry: Dict[str, Any]) -> str:
+    user = entry["user"]
+    if entry["anon"]:
+        who = "аноним"
+    else:
+        who = html.escape(user.full_name)
+        if user.username:
+            who += f" (@{user.username})"
+        who += f" · <code>{user.id}</code>"
+
+    body = entry["text"]
+    if len(body) > DIGEST_ENTRY_LEN:
+        body = body[:DIGEST_ENTRY_LEN] + "…"
+    sent_at = time.strftime("%H:%M", time.localtime(entry["ts"]))
+    return f"\n<b>{index}.</b> {sent_at} · {who}\n{html.escape(body)}"
+
+
+def split_digest_entries(entries: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    posts: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    length = 0
+    for entry in entries:
+        size = len(format_digest_entry(len(current) + 1, entry))
+        if current and (len(current) >= DIGEST_MAX_ENTRIES or length + size > DIGEST_MAX_POST_LEN):
+            posts.append(current)
+            current, length = [], 0
+        current.append(entry)
+        length += size
+    if current:
+        posts.append(current)
+    return posts
+
+
+def build_digest_text(entries: List[Dict[str, Any]]) -> str:
+    lines = [f"🗂 <b>Дайджест:</b> {len(entries)} сообщ. (кнопка с номером - ответить или заблокировать)"]
+    for i, entry in enumerate(entries, start=1):
+        lines.append(format_digest_entry(i, entry))
+    return "\n".join(lines)
+
+
+def make_digest_keyboard(count: int) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(text=f"↩️ {i + 1}", callback_data=f"digest:{i}")
+        for i in range(count)
+    ]
+    return InlineKeyboardMarkup(
+        inline_keyboard=[buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    )
+
+
+async def flush_digest() -> None:
+    for chat_id in list(digest_pending):
+        entries = digest_pending.pop(chat_id)
+        posts = split_digest_entries(entries)
+        for n, post in enumerate(posts):
+            try:
+                sent = await bot.send_message(
+                    chat_id=chat_id,
+                    text=build_digest_text(post),
+                    reply_markup=make_digest_keyboard(len(post)),
+                    disable_web_page_preview=True,
+                )
+            except Exception as e:
+                rest = [entry for p in posts[n:] for entry in p]
+                if not is_transient_api_error(e):
+                    # повтор не поможет (чат недоступен, бот исключен и т.п.)
+                    logging.exception("Failed to send digest to %s, dropped %d entries", chat_id, len(rest))
+                    break
+                logging.warning("Failed to send digest to %s, will retry: %r", chat_id, e)
+                # неотправленное - в начало следующего дайджеста
+                queued = rest + digest_pending.get(chat_id, [])
+                if len(queued) > DIGEST_MAX_PENDING:
+                    logging.warning(
+                        "Digest queue for %s is full, dropped %d oldest entries",
+                        chat_id, len(queued) - DIGEST_MAX_PENDING,
+                    )
+                    queued = queued[-DIGEST_MAX_PENDING:]
+                digest_pending[chat_id] = queued
+                break
+
+            key = (chat_id, sent.message_id)
+            digest_posts[key] = post
+            while len(digest_posts) > DIGEST_POSTS_KEPT:
+                digest_posts.popitem(last=False)
+
+            senders = {entry["user"].id for entry in post}
+            if len(senders) == 1:
+                # дайджест от одного человека - на него можно ответить как на обычный пост
+                message_targets[key] = next(iter(senders))
+                expect_reply(chat_id, sent.message_id, min(entry["ts"] for entry in post))
+
+            # каждая запись - полноценное входящее: в статистике и в /inbox она есть
+            # сразу, а не только если админ раскроет карточку
+            for i, entry in enumerate(post, start=1):
+                count_forward(entry["ts"])
+                inbox_add(
+                    chat_id, sent.message_id, entry["user"].id, entry["ts"],
+                    entry["anon"], entry["text"], part=i,
+                )
+                spawn_background(
+                    index_message_text(entry["user"].id, entry["anon"], chat_id, sent.message_id, entry["text"])
+                )
+
+
+async def run_digest() -> None:
+    while True:
+        await asyncio.sleep(DIGEST_INTERVAL)
+        try:
+            await flush_digest()
+        except Exception:
+            logging.exception("Digest flush failed")
+
+
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("digest:"))
+async def handle_digest_callback(callback: types.CallbackQuery):
+    data = callback.data or ""
+    try:
+        _, index_str = data.split(":", 1)
+        index = int(index_str)
+    except Exception:
+        await callback.answer("Ошибка при выборе записи.", show_alert=True)
+        return
+
+    chat_id = callback.message.chat.id
+    entries = digest_posts.get((chat_id, callback.message.message_id))
+    if not entries or not 0 <= index < len(entries):
+        await callback.answer("Дайджест устарел, запись недоступна.", show_alert=True)
+        return
+
+    entry = entries[index]
+    if entry["card_id"] is not None:
+        await callback.answer("Карточка уже отправлена - ответьте на нее.", show_alert=False)
+        return
+
+    # запись разворачиваем в обычную карточку: ответ на нее уходит пользователю,
+    # под ней привычные кнопки бана, истории и тегов
+    user_id = entry["user"].id
+    if user_id in banned_users:
+        kb = make_unban_keyboard(user_id)
+    else:
+        kb = make_ban_keyboard(user_id)
+    sent, _ = await run_concurrently(
+        bot.send_message(
+            chat_id=chat_id,
+            text=build_admin_message_text(entry["user"], entry["anon"], "text", entry["text"]),
+            reply_markup=kb,
+            reply_to_message_id=callback.message.message_id,
+        ),
+        callback.answer(),
+    )
+
+    entry["card_id"] = sent.message_id
+    message_targets[(chat_id, sent.message_id)] = user_id
+    # пересылку уже посчитали при отправке дайджеста; время ответа - от прихода сообщения
+    expect_reply(chat_id, sent.message_id, entry["ts"])
+    # запись в /inbox переезжает на карточку, если на нее еще не ответили
+    if inbox_remove((chat_id, callback.message.message_id, index + 1)):
+        inbox_add(chat_id, sent.message_id, user_id, entry["ts"], entry["anon"], entry["text"])
+
+
 # --- Сообщения пользователей боту в личке ---
 
 
@@ -548,14 +1997,8 @@ async def handle_user_message(message: types.Message):
         return
 
     # Определяем тип сообщения
-    kind = None
-    if message.text:
-        kind = "text"
-    elif message.photo:
-        kind = "photo"
-    elif message.video:
-        kind = "video"
-    else:
+    kind = message.content_type
+    if kind != "text" and kind not in CAPTION_CONTENT_TYPES and kind not in PLAIN_COPY_CONTENT_TYPES:
         kind = "unsupported"
 
     media_group_id = message.media_group_id
@@ -565,13 +2008,16 @@ async def handle_user_message(message: types.Message):
             is_album_first = False
         else:
             is_album_first = True
-            handled_media_groups.add(media_group_id)
+            handled_media_groups[media_group_id] = time.time()
 
     # Если тип не поддерживается – просто скажем об этом, без "спасибо"
     if kind == "unsupported":
         await message.answer(build_unsupported_text(lang))
         return
 
+    # каждое сообщение (включая элементы альбома) - в историю переписки
+    spawn_background(record_history(user_id, HISTORY_IN, describe_message(message)))
+
     # Логируем сообщение для статистики (один раз на альбом)
     if (not media_group_id) or is_album_first:
         user_message_log.append(
@@ -582,21 +2028,57 @@ async def handle_user_message(message: types.Message):
                 "is_anon": anon,
             }
         )
+        track_incoming_message(user_id, anon, time.time())
+
+    async with CallScope() as scope:
+        # "Спасибо" только если сообщение будет реально отправлено (и раз на альбом);
+        # уходит параллельно с пересылкой админам, а не перед ней
+        if (not media_group_id) or is_album_first:
+            thanks_text = build_thanks_text(lang)
+            scope.start(
+                send_or_defer(lambda: bot.send_message(chat_id=user_id, text=thanks_text))
+            )
 
-    # "Спасибо" только если сообщение будет реально отправлено (и раз на альбом)
-    if (not media_group_id) or is_album_first:
-        await message.answer(build_thanks_text(lang))
+        await forward_user_message(message, kind, anon, is_album_first)
 
-    sent_msg: types.Message | None = None
 
-    # --- Текст (с анти-дубляжом, включая дополнения к медиа) ---
-    if kind == "text":
-        now = time.time()
-        info = last_admin_message.get(user_id)
+async def forward_user_message(
+    message: types.Message,
+    kind: str,
+    anon: bool,
+    is_album_first: bool,
+) -> None:
+    user = message.from_user
+    user_id = user.id
+    media_group_id = message.media_group_id
 
-        if info and now - info["time"] <= 60:
-            # есть последнее сообщение (может быть текст или медиа), добавим "Дополнение"
-            old_text = info["text"]
+    # тот же текст/фото/видео уже переслан недавно (в т.ч. от других) - только счетчик у поста
+    flood_keys = None
+    if not media_group_id:
+        flood_keys = build_flood_keys(message)
+        if flood_keys and fold_flood_repeat(flood_keys, user_id):
+            return
+
+    admin_chat_id = pick_admin_chat(user_id)
+
+    # тексты обычных пользователей копим для дайджеста; свежий отдельный пост
+    # пользователя по-прежнему дополняем, чтобы не дробить его мысль
+    if kind == "text" and not media_group_id and digest_applies(admin_chat_id, user_id):
+        info = last_admin_message.get(user_id)
+        if not (info and time.time() - info["time"] <= 60):
+            queue_digest_entry(admin_chat_id, user, anon, message.text)
+            return
+
+    sent_msg_id: int | None = None
+
+    # --- Текст (с анти-дубляжом, включая дополнения к медиа) ---
+    if kind == "text":
+        now = time.time()
+        info = last_admin_message.get(user_id)
+
+        if info and now - info["time"] <= 60:
+            # есть последнее сообщение (может быть текст или медиа), добавим "Дополнение"
+            old_text = info["text"]
             new_block = old_text + "\n\n➕ <b>Дополнение:</b>\n" + message.text
 
             # выбираем клавиатуру в зависимости от бан/не бан
@@ -610,7 +2092,7 @@ async def handle_user_message(message: types.Message):
                 await bot.edit_message_caption(
                     chat_id=info["chat_id"],
                     message_id=info["message_id"],
-                    caption=new_block,
+                    caption=new_block + flood_suffix(info["chat_id"], info["message_id"]),
                     reply_markup=kb,
                 )
             else:
@@ -618,136 +2100,325 @@ async def handle_user_message(message: types.Message):
                 await bot.edit_message_text(
                     chat_id=info["chat_id"],
                     message_id=info["message_id"],
-                    text=new_block,
+                    text=new_block + flood_suffix(info["chat_id"], info["message_id"]),
                     reply_markup=kb,
                 )
 
             info["time"] = now
             info["text"] = new_block
             last_admin_message[user_id] = info
-            sent_msg = None
+            cluster_id = flood_by_message.get((info["chat_id"], info["message_id"]))
+            if cluster_id is not None:
+                flood_clusters[cluster_id]["text"] = new_block
         else:
             # создаем новое текстовое сообщение
-            if anon:
-                base_text = (
-                    "📩 <b>Новое анонимное сообщение</b>\n\n"
-                    f"💬 <b>Текст:</b>\n{message.text}"
-                )
-            else:
-                user_block = format_user_info(user)
-                base_text = (
-                    "📩 <b>Новое сообщение от пользователя</b>\n\n"
-                    f"{user_block}\n\n"
-                    f"💬 <b>Текст:</b>\n{message.text}"
-                )
+            base_text = build_admin_message_text(user, anon, kind, message.text)
 
             sent_msg = await bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
+                chat_id=admin_chat_id,
                 text=base_text,
                 reply_markup=make_ban_keyboard(user_id),
             )
+            sent_msg_id = sent_msg.message_id
             last_admin_message[user_id] = {
-                "chat_id": ADMIN_CHAT_ID,
-                "message_id": sent_msg.message_id,
+                "chat_id": admin_chat_id,
+                "message_id": sent_msg_id,
                 "text": base_text,
                 "time": now,
                 "has_media": False,
                 "is_anon": anon,
             }
 
-    # --- Фото ---
-    elif kind == "photo":
-        caption = message.caption or ""
-        if anon:
-            admin_caption = (
-                "📩 <b>Новое анонимное сообщение с фото</b>\n\n"
-                f"💬 <b>Подпись:</b>\n{caption}"
-            )
-        else:
-            user_block = format_user_info(user)
-            admin_caption = (
-                "📩 <b>Новое сообщение с фото от пользователя</b>\n\n"
-                f"{user_block}\n\n"
-                f"💬 <b>Подпись:</b>\n{caption}"
-            )
+    # --- Остальные элементы альбома: копим и копируем пачкой ---
+    elif media_group_id and not is_album_first:
+        queue_album_copy(media_group_id, user_id, message.chat.id, message.message_id)
+        return
 
-        # если это часть альбома, но не первая – просто досылаем фото
-        if media_group_id and not is_album_first:
-            await bot.send_photo(
-                chat_id=ADMIN_CHAT_ID,
-                photo=message.photo[-1].file_id,
-                caption=caption or None,
-            )
-            return
+    # --- Медиа с подписью: одно копирование с шапкой в подписи ---
+    elif kind in CAPTION_CONTENT_TYPES:
+        admin_caption = build_admin_message_text(user, anon, kind, message.caption or "")
 
-        sent_msg = await bot.send_photo(
-            chat_id=ADMIN_CHAT_ID,
-            photo=message.photo[-1].file_id,
+        copied = await bot.copy_message(
+            chat_id=admin_chat_id,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id,
             caption=admin_caption,
             reply_markup=make_ban_keyboard(user_id),
         )
+        sent_msg_id = copied.message_id
 
         last_admin_message[user_id] = {
-            "chat_id": ADMIN_CHAT_ID,
-            "message_id": sent_msg.message_id,
+            "chat_id": admin_chat_id,
+            "message_id": sent_msg_id,
             "text": admin_caption,
             "time": time.time(),
             "has_media": True,
             "is_anon": anon,
         }
 
-    # --- Видео ---
-    elif kind == "video":
-        caption = message.caption or ""
-        if anon:
-            admin_caption = (
-                "📩 <b>Новое анонимное сообщение с видео</b>\n\n"
-                f"💬 <b>Подпись:</b>\n{caption}"
-            )
-        else:
-            user_block = format_user_info(user)
-            admin_caption = (
-                "📩 <b>Новое сообщение с видео от пользователя</b>\n\n"
-                f"{user_block}\n\n"
-                f"💬 <b>Подпись:</b>\n{caption}"
-            )
-
-        if media_group_id and not is_album_first:
-            await bot.send_video(
-                chat_id=ADMIN_CHAT_ID,
-                video=message.video.file_id,
-                caption=caption or None,
-            )
-            return
+    # --- Стикеры, кружки, геопозиции и т.п.: шапка + копия ответом на нее ---
+    else:
+        header_text = build_admin_message_text(user, anon, kind, None)
 
-        sent_msg = await bot.send_video(
-            chat_id=ADMIN_CHAT_ID,
-            video=message.video.file_id,
-            caption=admin_caption,
+        header_msg = await bot.send_message(
+            chat_id=admin_chat_id,
+            text=header_text,
             reply_markup=make_ban_keyboard(user_id),
         )
+        sent_msg_id = header_msg.message_id
+
+        copied = await bot.copy_message(
+            chat_id=admin_chat_id,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id,
+            reply_to_message_id=sent_msg_id,
+        )
+        # на саму копию тоже можно ответить
+        message_targets[(admin_chat_id, copied.message_id)] = user_id
+        message_roots[(admin_chat_id, copied.message_id)] = (admin_chat_id, sent_msg_id)
 
         last_admin_message[user_id] = {
-            "chat_id": ADMIN_CHAT_ID,
-            "message_id": sent_msg.message_id,
-            "text": admin_caption,
+            "chat_id": admin_chat_id,
+            "message_id": sent_msg_id,
+            "text": header_text,
             "time": time.time(),
-            "has_media": True,
+            "has_media": False,
             "is_anon": anon,
         }
 
+    if sent_msg_id:
+        message_targets[(admin_chat_id, sent_msg_id)] = user_id
+        if media_group_id:
+            album_posts[media_group_id] = (admin_chat_id, sent_msg_id)
+        track_forward(admin_chat_id, sent_msg_id, time.time())
+        inbox_add(
+            admin_chat_id,
+            sent_msg_id,
+            user_id,
+            time.time(),
+            anon,
+            message.text or message.caption or "",
+        )
+        alert_tags = [
+            tag for tag, info in TAG_TYPES.items() if info["alert"] and user_id in tagged_users[tag]
+        ]
+        if alert_tags:
+            spawn_background(send_tag_alert(admin_chat_id, sent_msg_id, alert_tags))
+        if flood_keys:
+            register_flood_cluster(
+                flood_keys,
+                admin_chat_id,
+                sent_msg_id,
+                user_id,
+                last_admin_message[user_id]["has_media"],
+                last_admin_message[user_id]["text"],
+            )
+
+    # текст/подпись в поисковый индекс, со ссылкой на сообщение в админ-группе
+    body = message.text or message.caption
+    if body:
+        info = last_admin_message[user_id]
+        spawn_background(
+            index_message_text(user_id, anon, info["chat_id"], info["message_id"], body)
+        )
+
+
+# --- Очередь недоставленных ответов админов (outbox) ---
+
+OUTBOX_POLL_INTERVAL = 10.0
+OUTBOX_BATCH = 20
+OUTBOX_MAX_DELAY = 300.0
+
+REPLY_DELIVERY_UNKNOWN_TEXT = (
+    "⚠️ Telegram не ответил вовремя: неизвестно, дошел ли ответ до пользователя. "
+    "Повторно не отправляю, чтобы не продублировать; при необходимости ответьте еще раз."
+)
+
+outbox_executor = shared_resource(
+    "outbox_executor", lambda: ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+)
+outbox_db: sqlite3.Connection | None = None
+
+
+def _get_outbox_db() -> sqlite3.Connection:
+    global outbox_db
+    if outbox_db is None:
+        conn = sqlite3.connect(OUTBOX_DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY, "
+            "user_id INTEGER NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "text TEXT NOT NULL, "
+            "from_chat_id INTEGER NOT NULL, "
+            "message_id INTEGER NOT NULL, "
+            "created REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL, "
+            "header_id INTEGER)"
+        )
+        # базы, созданные до колонки header_id
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+        if "header_id" not in columns:
+            conn.execute("ALTER TABLE outbox ADD COLUMN header_id INTEGER")
+        conn.commit()
+        outbox_db = conn
+    return outbox_db
+
+
+def _outbox_put_sync(
+    user_id: int,
+    kind: str,
+    text: str,
+    from_chat_id: int,
+    message_id: int,
+    header_id: int | None,
+) -> None:
+    now = time.time()
+    conn = _get_outbox_db()
+    conn.execute(
+        "INSERT INTO outbox (user_id, kind, text, from_chat_id, message_id, created, next_attempt, header_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, kind, text, from_chat_id, message_id, now, now + OUTBOX_POLL_INTERVAL, header_id),
+    )
+    conn.commit()
+
+
+def _outbox_due_sync(now: float) -> List[Dict[str, Any]]:
+    rows = _get_outbox_db().execute(
+        "SELECT id, user_id, kind, text, from_chat_id, message_id, attempts, header_id "
+        "FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+        (now, OUTBOX_BATCH),
+    ).fetchall()
+    keys = ("id", "user_id", "kind", "text", "from_chat_id", "message_id", "attempts", "header_id")
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def _outbox_done_sync(item_id: int) -> None:
+    conn = _get_outbox_db()
+    conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+    conn.commit()
+
+
+def _outbox_retry_later_sync(item_id: int, attempts: int, header_id: int | None) -> None:
+    delay = min(OUTBOX_MAX_DELAY, OUTBOX_POLL_INTERVAL * 2 ** attempts)
+    conn = _get_outbox_db()
+    conn.execute(
+        "UPDATE outbox SET attempts = ?, next_attempt = ?, header_id = ? WHERE id = ?",
+        (attempts, time.time() + delay, header_id, item_id),
+    )
+    conn.commit()
+
+
+async def outbox_call(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(outbox_executor, func, *args)
+
+
+async def deliver_admin_reply(
+    user_id: int,
+    kind: str,
+    text: str,
+    from_chat_id: int,
+    message_id: int,
+    progress: Dict[str, Any],
+) -> None:
+    # progress["header_id"] - уже доставленная шапка "plain"-ответа: при повторе
+    # досылаем только копию, а не вторую шапку
+    if kind == "caption":
+        # одна копия с шапкой в подписи вместо отдельного send_* под каждый тип
+        await bot.copy_message(
+            chat_id=user_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
+            caption=text,
+        )
+    elif kind == "plain":
+        if progress.get("header_id") is None:
+            header_msg = await bot.send_message(chat_id=user_id, text=text)
+            progress["header_id"] = header_msg.message_id
+        await bot.copy_message(
+            chat_id=user_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
+            reply_to_message_id=progress["header_id"],
+        )
     else:
-        await message.answer(build_unsupported_text(lang))
-        return
+        await bot.send_message(chat_id=user_id, text=text)
+
+
+async def process_outbox() -> None:
+    items = await outbox_call(_outbox_due_sync, time.time())
+    for item in items:
+        token = update_deadline.set(time.monotonic() + UPDATE_BUDGET)
+        progress = {"header_id": item["header_id"]}
+        try:
+            await deliver_admin_reply(
+                item["user_id"],
+                item["kind"],
+                item["text"],
+                item["from_chat_id"],
+                item["message_id"],
+                progress,
+            )
+        except Exception as e:
+            if is_unsent_api_error(e):
+                await outbox_call(
+                    _outbox_retry_later_sync, item["id"], item["attempts"] + 1, progress["header_id"]
+                )
+                # API все еще лежит - остальное не трогаем до следующего круга
+                return
+            if is_transient_api_error(e):
+                # запрос мог дойти - повтор рискует продублировать ответ
+                logging.warning("Queued reply %s to user %s may not be delivered: %r", item["id"], item["user_id"], e)
+                await outbox_call(_outbox_done_sync, item["id"])
+                await quietly(
+                    bot.send_message(
+                        chat_id=item["from_chat_id"],
+                        text=REPLY_DELIVERY_UNKNOWN_TEXT,
+                        reply_to_message_id=item["message_id"],
+                    )
+                )
+                return
+            logging.warning("Dropping queued reply %s to user %s: %r", item["id"], item["user_id"], e)
+            await outbox_call(_outbox_done_sync, item["id"])
+            await quietly(
+                bot.send_message(
+                    chat_id=item["from_chat_id"],
+                    text="❌ Отложенный ответ не удалось доставить пользователю.",
+                    reply_to_message_id=item["message_id"],
+                )
+            )
+            continue
+        finally:
+            update_deadline.reset(token)
+
+        await outbox_call(_outbox_done_sync, item["id"])
+        await quietly(
+            bot.send_message(
+                chat_id=item["from_chat_id"],
+                text="✅ Отложенный ответ доставлен пользователю.",
+                reply_to_message_id=item["message_id"],
+            )
+        )
 
-    if sent_msg:
-        message_targets[(ADMIN_CHAT_ID, sent_msg.message_id)] = user_id
+
+async def run_outbox() -> None:
+    while True:
+        try:
+            await process_outbox()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Outbox processing failed")
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
 
 
 # --- Ответы админов в группе (реплай на сообщение бота) ---
 
 
-@dp.message(F.chat.id == ADMIN_CHAT_ID, F.reply_to_message)
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.reply_to_message)
 async def handle_admin_reply(message: types.Message):
     key = (message.chat.id, message.reply_to_message.message_id)
     user_id = message_targets.get(key)
@@ -764,30 +2435,61 @@ async def handle_admin_reply(message: types.Message):
         await message.reply("Пользователь уже заблокирован, ответ не отправлен.")
         return
 
-    if message.text:
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"{header}\n\n{message.text}",
+    kind = message.content_type
+
+    if kind == "text":
+        reply_kind, reply_text = "text", f"{header}\n\n{message.text}"
+    elif kind in CAPTION_CONTENT_TYPES:
+        reply_kind, reply_text = "caption", f"{header}\n\n{message.caption or ''}"
+    elif kind in PLAIN_COPY_CONTENT_TYPES:
+        reply_kind, reply_text = "plain", header
+    else:
+        reply_kind, reply_text = (
+            "text",
+            f"{header}\n\n(отправлен ответ, который я пока не умею переслать в исходном виде)",
         )
-    elif message.photo:
-        caption = message.caption or ""
-        await bot.send_photo(
-            chat_id=user_id,
-            photo=message.photo[-1].file_id,
-            caption=f"{header}\n\n{caption}",
+
+    root_chat_id, root_message_id = message_roots.get(key, key)
+    track_admin_reply(root_chat_id, root_message_id, time.time())
+    inbox_mark_answered(user_id, root_chat_id, root_message_id)
+    spawn_background(record_history(user_id, HISTORY_OUT, describe_message(message)))
+
+    progress: Dict[str, Any] = {"header_id": None}
+    try:
+        await deliver_admin_reply(
+            user_id,
+            reply_kind,
+            reply_text,
+            message.chat.id,
+            message.message_id,
+            progress,
         )
-    elif message.video:
-        caption = message.caption or ""
-        await bot.send_video(
-            chat_id=user_id,
-            video=message.video.file_id,
-            caption=f"{header}\n\n{caption}",
+    except Exception as e:
+        if not is_transient_api_error(e):
+            raise
+        if not is_unsent_api_error(e):
+            # таймаут или сбой посреди запроса: ответ мог и дойти, вслепую не повторяем
+            logging.warning("Reply to user %s may not be delivered: %r", user_id, e)
+            await quietly(message.reply(REPLY_DELIVERY_UNKNOWN_TEXT))
+            return
+        # Telegram API недоступен - ответ не теряем, доставим, когда он поднимется
+        logging.warning("Queueing reply to user %s: %r", user_id, e)
+        await outbox_call(
+            _outbox_put_sync,
+            user_id,
+            reply_kind,
+            reply_text,
+            message.chat.id,
+            message.message_id,
+            progress["header_id"],
         )
-    else:
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"{header}\n\n(отправлен ответ, который я пока не умею переслать в исходном виде)",
+        await quietly(
+            message.reply(
+                "⏳ Telegram сейчас недоступен, ответ поставлен в очередь "
+                "и будет доставлен автоматически."
+            )
         )
+        return
 
     await message.reply("✅ Ответ отправлен пользователю.")
 
@@ -795,7 +2497,7 @@ async def handle_admin_reply(message: types.Message):
 # --- Кнопки бана и разбана ---
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("ban:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("ban:"))
 async def handle_ban_button(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -821,11 +2523,13 @@ async def handle_ban_button(callback: types.CallbackQuery):
             ],
         ]
     )
-    await callback.message.edit_reply_markup(reply_markup=kb)
-    await callback.answer("Вы уверены, что хотите заблокировать пользователя?", show_alert=False)
+    await run_concurrently(
+        callback.message.edit_reply_markup(reply_markup=kb),
+        callback.answer("Вы уверены, что хотите заблокировать пользователя?", show_alert=False),
+    )
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("banconfirm:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("banconfirm:"))
 async def handle_ban_confirm(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -836,30 +2540,37 @@ async def handle_ban_confirm(callback: types.CallbackQuery):
         return
 
     banned_users.add(target_user_id)
+    invalidate_stats_cache()
+    inbox_clear_user(target_user_id)
 
     ts = time.time()
-    name = None
-    username = None
-    try:
-        chat = await bot.get_chat(target_user_id)
-        name = chat.full_name
-        username = chat.username
-    except Exception:
-        pass
-
     ban_log[target_user_id] = {
         "timestamp": ts,
-        "name": name,
-        "username": username,
+        "name": None,
+        "username": None,
     }
 
-    await callback.message.edit_reply_markup(
-        reply_markup=make_unban_keyboard(target_user_id)
+    async def fill_ban_info():
+        try:
+            chat = await bot.get_chat(target_user_id)
+        except Exception:
+            return
+        info = ban_log.get(target_user_id)
+        if info is not None and info["timestamp"] == ts:
+            info["name"] = chat.full_name
+            info["username"] = chat.username
+
+    # данные профиля для /bans подтягиваем параллельно с обновлением кнопок
+    await run_concurrently(
+        fill_ban_info(),
+        callback.message.edit_reply_markup(
+            reply_markup=make_unban_keyboard(target_user_id)
+        ),
+        callback.answer("Пользователь добавлен в черный список.", show_alert=False),
     )
-    await callback.answer("Пользователь добавлен в черный список.", show_alert=False)
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("bancancel:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("bancancel:"))
 async def handle_ban_cancel(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -869,13 +2580,15 @@ async def handle_ban_cancel(callback: types.CallbackQuery):
         await callback.answer("Отмена.", show_alert=False)
         return
 
-    await callback.message.edit_reply_markup(
-        reply_markup=make_ban_keyboard(target_user_id)
+    await run_concurrently(
+        callback.message.edit_reply_markup(
+            reply_markup=make_ban_keyboard(target_user_id)
+        ),
+        callback.answer("Блокировка отменена.", show_alert=False),
     )
-    await callback.answer("Блокировка отменена.", show_alert=False)
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("unban:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("unban:"))
 async def handle_unban_button(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -901,11 +2614,13 @@ async def handle_unban_button(callback: types.CallbackQuery):
             ],
         ]
     )
-    await callback.message.edit_reply_markup(reply_markup=kb)
-    await callback.answer("Подтвердить разблокировку пользователя?", show_alert=False)
+    await run_concurrently(
+        callback.message.edit_reply_markup(reply_markup=kb),
+        callback.answer("Подтвердить разблокировку пользователя?", show_alert=False),
+    )
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("unbanconfirm:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("unbanconfirm:"))
 async def handle_unban_confirm(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -916,15 +2631,18 @@ async def handle_unban_confirm(callback: types.CallbackQuery):
         return
 
     banned_users.discard(target_user_id)
+    invalidate_stats_cache()
     ban_log.pop(target_user_id, None)
 
-    await callback.message.edit_reply_markup(
-        reply_markup=make_ban_keyboard(target_user_id)
+    await run_concurrently(
+        callback.message.edit_reply_markup(
+            reply_markup=make_ban_keyboard(target_user_id)
+        ),
+        callback.answer("Пользователь удален из черного списка.", show_alert=False),
     )
-    await callback.answer("Пользователь удален из черного списка.", show_alert=False)
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("unbancancel:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("unbancancel:"))
 async def handle_unban_cancel(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -934,13 +2652,15 @@ async def handle_unban_cancel(callback: types.CallbackQuery):
         await callback.answer("Отмена.", show_alert=False)
         return
 
-    await callback.message.edit_reply_markup(
-        reply_markup=make_unban_keyboard(target_user_id)
+    await run_concurrently(
+        callback.message.edit_reply_markup(
+            reply_markup=make_unban_keyboard(target_user_id)
+        ),
+        callback.answer("Разблокировка отменена.", show_alert=False),
     )
-    await callback.answer("Разблокировка отменена.", show_alert=False)
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("tag:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("tag:"))
 async def handle_tag_callback(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -950,38 +2670,102 @@ async def handle_tag_callback(callback: types.CallbackQuery):
         await callback.answer("Ошибка при разборе тега.", show_alert=True)
         return
 
-    tags = get_user_tags(target_user_id)
-
-    if tag_type == "fav":
-        tags["fav"] = not tags["fav"]
-        msg = "Добавлен в избранное." if tags["fav"] else "Удалён из избранного."
-    elif tag_type == "watch":
-        tags["watch"] = not tags["watch"]
-        msg = "Добавлен под наблюдение." if tags["watch"] else "Метка снята."
-    else:
+    info = TAG_TYPES.get(tag_type)
+    if info is None:
         await callback.answer("Неизвестный тип тега.", show_alert=True)
         return
 
-    user_tags[target_user_id] = tags
+    on = not has_tag(target_user_id, tag_type)
+    set_user_tag(target_user_id, tag_type, on)
+    msg = info["on"] if on else info["off"]
+    inbox_reprioritize_user(target_user_id)
+
+    async with CallScope() as scope:
+        # пересобираем клавиатуру (под нагрузкой пропускаем - метка уже сохранена)
+        if get_load_level() < LOAD_LEVEL_SKIP_COSMETIC:
+            if target_user_id in banned_users:
+                kb = make_unban_keyboard(target_user_id)
+            else:
+                kb = make_ban_keyboard(target_user_id)
+            scope.start(quietly(callback.message.edit_reply_markup(reply_markup=kb)))
+
+        scope.start(callback.answer(msg, show_alert=False))
+
+
+# --- Списки пользователей по тегам (/fav, /watch) и оповещения ---
+
+TAG_LIST_PAGE_SIZE = 20
+
+
+async def send_tag_alert(chat_id: int, message_id: int, tags: List[str]) -> None:
+    titles = ", ".join(f"{TAG_TYPES[tag]['icon']} {TAG_TYPES[tag]['title']}" for tag in tags)
+    text = f"🔔 <b>Новое сообщение от пользователя из списка:</b> {titles}"
+    if TAG_ALERT_MENTION:
+        text += f"\n{html.escape(TAG_ALERT_MENTION)}"
+    await quietly(bot.send_message(chat_id=chat_id, text=text, reply_to_message_id=message_id))
 
-    # пересобираем клавиатуру
-    if target_user_id in banned_users:
-        kb = make_unban_keyboard(target_user_id)
-    else:
-        kb = make_ban_keyboard(target_user_id)
 
+def build_tag_list_page(tag: str, page: int) -> Tuple[str, InlineKeyboardMarkup | None]:
+    info = TAG_TYPES[tag]
+    users = tagged_users[tag]
+    total = len(users)
+    if not total:
+        return f"{info['icon']} В списке «{info['title']}» пока никого нет.", None
+
+    pages = (total + TAG_LIST_PAGE_SIZE - 1) // TAG_LIST_PAGE_SIZE
+    page = min(page, pages - 1)
+    start = page * TAG_LIST_PAGE_SIZE
+
+    lines = [f"{info['icon']} <b>{info['title']}:</b> {total} (стр. {page + 1}/{pages})\n"]
+    for i, (user_id, tagged_at) in enumerate(
+        itertools.islice(users.items(), start, start + TAG_LIST_PAGE_SIZE), start=start + 1
+    ):
+        # анонимов не раскрываем и в списках
+        if user_settings.get(user_id, {}).get("anon"):
+            who = "аноним"
+        else:
+            who = f'<a href="tg://user?id={user_id}">{user_id}</a>'
+        since = time.strftime("%d.%m.%Y", time.localtime(tagged_at))
+        lines.append(f"{i}) {who} — с {since}")
+
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"taglist:{tag}:{page - 1}"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton(text="Дальше ➡️", callback_data=f"taglist:{tag}:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[row]) if row else None
+
+
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text.in_({f"/{tag}" for tag in TAG_TYPES}))
+async def cmd_tag_list(message: types.Message):
+    text, kb = build_tag_list_page(message.text[1:], 0)
+    await message.reply(text, reply_markup=kb)
+
+
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("taglist:"))
+async def handle_tag_list_callback(callback: types.CallbackQuery):
+    data = callback.data or ""
     try:
-        await callback.message.edit_reply_markup(reply_markup=kb)
+        _, tag, page_str = data.split(":", 2)
+        page = max(int(page_str), 0)
     except Exception:
-        pass
+        await callback.answer("Ошибка при выборе страницы.", show_alert=True)
+        return
+    if tag not in TAG_TYPES:
+        await callback.answer("Неизвестный тип тега.", show_alert=True)
+        return
 
-    await callback.answer(msg, show_alert=False)
+    text, kb = build_tag_list_page(tag, page)
+    await run_concurrently(
+        quietly(callback.message.edit_text(text, reply_markup=kb)),
+        callback.answer(),
+    )
 
 
 # --- /bans: список банов ---
 
 
-@dp.message(F.chat.id == ADMIN_CHAT_ID, F.text == "/bans")
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text == "/bans")
 async def cmd_bans(message: types.Message):
     if not banned_users:
         await message.reply("🚫 В черном списке пока никого нет.")
@@ -1011,6 +2795,255 @@ async def cmd_bans(message: types.Message):
         await message.reply(text, reply_markup=make_unban_keyboard(uid))
 
 
+# --- Аналитика: время ответа админов, нагрузка по часам, топ отправителей ---
+
+# почасовые корзины храним месяц, более старые сливаем в общий итог
+ANALYTICS_BUCKET_SECONDS = 60 * 60
+ANALYTICS_RETENTION_BUCKETS = 31 * 24
+TOP_SENDERS_PER_BUCKET = 20
+# столько неотвеченных постов ждем ответа; самые старые сверх лимита забываем -
+# в статистике они так и остаются неотвеченными
+PENDING_REPLIES_MAX = int(os.getenv("PENDING_REPLIES_MAX", "100000"))
+TOP_SENDERS_SHOWN = 5
+
+
+class QuantileSketch:
+    """Квантили с относительной ошибкой (по мотивам DDSketch).
+
+    Значения раскладываются по логарифмическим корзинам, поэтому скетчи
+    разных периодов складываются простым сложением счетчиков.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.02, max_bins: int = 512):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins: Dict[int, int] = {}
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        key = math.ceil(math.log(max(value, 1e-3)) / self.log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        self.count += 1
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        for key, n in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + n
+        self.count += other.count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        # сливаем самые маленькие корзины - точность страдает только у нижних квантилей
+        keys = sorted(self.bins)
+        extra = len(keys) - self.max_bins
+        target = keys[extra]
+        for key in keys[:extra]:
+            self.bins[target] += self.bins.pop(key)
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return None
+
+
+class TopSenders:
+    """Top-k отправителей по алгоритму Space-Saving: не больше capacity счетчиков."""
+
+    def __init__(self, capacity: int = TOP_SENDERS_PER_BUCKET):
+        self.capacity = capacity
+        self.counts: Dict[int, int] = {}
+
+    def add(self, user_id: int) -> None:
+        if user_id in self.counts:
+            self.counts[user_id] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[user_id] = 1
+        else:
+            victim = min(self.counts, key=self.counts.__getitem__)
+            self.counts[user_id] = self.counts.pop(victim) + 1
+
+    def merge(self, other: "TopSenders") -> None:
+        for user_id, n in other.counts.items():
+            self.counts[user_id] = self.counts.get(user_id, 0) + n
+        if len(self.counts) > self.capacity:
+            top = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+            self.counts = dict(top[:self.capacity])
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+def new_analytics_bucket() -> Dict[str, Any]:
+    return {
+        "messages": 0,
+        "forwarded": 0,
+        "answered": 0,
+        "latency": QuantileSketch(),
+        "senders": TopSenders(),
+        "hours": [0] * 24,
+    }
+
+
+# номер часа (timestamp // 3600) -> корзина; dict хранит порядок вставки = порядок времени
+analytics_buckets: Dict[int, Dict[str, Any]] = {}
+
+# все, что старше ANALYTICS_RETENTION_BUCKETS, - для статистики "за все время"
+analytics_total: Dict[str, Any] = new_analytics_bucket()
+
+# (chat_id, message_id) пересланного сообщения -> время пересылки, пока админ не ответил
+pending_replies: Dict[Tuple[int, int], float] = {}
+
+
+def get_analytics_bucket(ts: float) -> Dict[str, Any]:
+    key = int(ts // ANALYTICS_BUCKET_SECONDS)
+    bucket = analytics_buckets.get(key)
+    if bucket is None:
+        bucket = new_analytics_bucket()
+        analytics_buckets[key] = bucket
+        evict_analytics_buckets(key)
+    return bucket
+
+
+def merge_analytics_bucket(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+    dst["messages"] += src["messages"]
+    dst["forwarded"] += src["forwarded"]
+    dst["answered"] += src["answered"]
+    dst["latency"].merge(src["latency"])
+    dst["senders"].merge(src["senders"])
+    for hour in range(24):
+        dst["hours"][hour] += src["hours"][hour]
+
+
+def evict_analytics_buckets(current_key: int) -> None:
+    oldest_allowed = current_key - ANALYTICS_RETENTION_BUCKETS
+    while analytics_buckets:
+        key = next(iter(analytics_buckets))
+        if key >= oldest_allowed:
+            break
+        merge_analytics_bucket(analytics_total, analytics_buckets.pop(key))
+
+    # неотвеченные за пределами окна больше не ждем - они уже посчитаны как forwarded
+    cutoff = oldest_allowed * ANALYTICS_BUCKET_SECONDS
+    while pending_replies:
+        key = next(iter(pending_replies))
+        if pending_replies[key] >= cutoff:
+            break
+        pending_replies.pop(key)
+
+
+def track_incoming_message(user_id: int, is_anon: bool, ts: float) -> None:
+    invalidate_stats_cache()
+    bucket = get_analytics_bucket(ts)
+    bucket["messages"] += 1
+    bucket["hours"][time.localtime(ts).tm_hour] += 1
+    # анонимов в топ не берем, чтобы не раскрывать их
+    if not is_anon:
+        bucket["senders"].add(user_id)
+
+
+def count_forward(ts: float) -> None:
+    invalidate_stats_cache()
+    get_analytics_bucket(ts)["forwarded"] += 1
+
+
+def expect_reply(chat_id: int, message_id: int, ts: float) -> None:
+    pending_replies[(chat_id, message_id)] = ts
+    while len(pending_replies) > PENDING_REPLIES_MAX:
+        del pending_replies[next(iter(pending_replies))]
+
+
+def track_forward(chat_id: int, message_id: int, ts: float) -> None:
+    count_forward(ts)
+    expect_reply(chat_id, message_id, ts)
+
+
+def track_admin_reply(chat_id: int, message_id: int, ts: float) -> None:
+    forwarded_at = pending_replies.pop((chat_id, message_id), None)
+    if forwarded_at is None:
+        return
+    invalidate_stats_cache()
+    # ответ засчитываем в корзину пересылки, чтобы доля неотвеченных считалась по ней
+    bucket = analytics_buckets.get(int(forwarded_at // ANALYTICS_BUCKET_SECONDS))
+    if bucket is None:
+        return
+    bucket["answered"] += 1
+    bucket["latency"].add(ts - forwarded_at)
+
+
+def collect_analytics(cutoff: float) -> Dict[str, Any]:
+    result = new_analytics_bucket()
+    if cutoff <= 0:
+        merge_analytics_bucket(result, analytics_total)
+    first_key = int(cutoff // ANALYTICS_BUCKET_SECONDS)
+    for key, bucket in analytics_buckets.items():
+        if key >= first_key:
+            merge_analytics_bucket(result, bucket)
+    return result
+
+
+def format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    if seconds < 60 * 60:
+        return f"{seconds / 60:.0f} мин"
+    if seconds < 24 * 60 * 60:
+        return f"{seconds / 3600:.1f} ч"
+    return f"{seconds / 86400:.1f} д"
+
+
+def build_analytics_text(cutoff: float) -> str:
+    data = collect_analytics(cutoff)
+    latency = data["latency"]
+
+    lines = ["\n\n⏱ <b>Ответы админов</b>"]
+    if latency.count:
+        lines.append(
+            f"Медиана: <b>{format_duration(latency.quantile(0.5))}</b>, "
+            f"p90: <b>{format_duration(latency.quantile(0.9))}</b>, "
+            f"p99: <b>{format_duration(latency.quantile(0.99))}</b>"
+        )
+    else:
+        lines.append("Ответов за период нет.")
+
+    forwarded = data["forwarded"]
+    if forwarded:
+        unanswered = max(forwarded - data["answered"], 0)
+        lines.append(
+            f"Без ответа: <b>{unanswered}</b> из {forwarded} "
+            f"({unanswered * 100 / forwarded:.0f}%)"
+        )
+
+    hours = data["hours"]
+    peak = max(hours)
+    if peak:
+        bars = "▁▂▃▄▅▆▇█"
+        spark = "".join(bars[(h * (len(bars) - 1)) // peak] if h else " " for h in hours)
+        peak_hour = hours.index(peak)
+        lines.append(
+            f"\n🕐 <b>Нагрузка по часам</b> (0–23)\n<code>{spark}</code>\n"
+            f"Пик: {peak_hour:02d}:00–{(peak_hour + 1) % 24:02d}:00 ({peak} сообщ.)"
+        )
+
+    top = data["senders"].top(TOP_SENDERS_SHOWN)
+    if top:
+        lines.append("\n🏆 <b>Самые активные</b> (без анонимных)")
+        for i, (uid, n) in enumerate(top, start=1):
+            lines.append(f"{i}) <code>{uid}</code> — {n}")
+
+    return "\n".join(lines)
+
+
 # --- Статистика: выбор периода и расчет ---
 
 
@@ -1054,52 +3087,78 @@ def make_stats_back_keyboard() -> InlineKeyboardMarkup:
     )
 
 
-@dp.message(F.chat.id == ADMIN_CHAT_ID, F.text == "/stats")
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text == "/stats")
 async def cmd_stats(message: types.Message):
     kb = make_stats_menu_keyboard()
     await message.reply("Выберите период для статистики:", reply_markup=kb)
 
 
-def build_stats_text(period: str) -> str:
-    now = time.time()
-
+def stats_cutoff(period: str, now: float) -> float:
     if period == "day":
-        cutoff = now - 24 * 60 * 60
+        return now - 24 * 60 * 60
     elif period == "week":
-        cutoff = now - 7 * 24 * 60 * 60
+        return now - 7 * 24 * 60 * 60
     elif period == "month":
-        cutoff = now - 30 * 24 * 60 * 60
+        return now - 30 * 24 * 60 * 60
     else:
-        cutoff = 0
+        return 0
+
+
+def collect_stats(cutoff: float) -> Dict[str, Any]:
+    # лог упорядочен по времени: начало периода находим бинарным поиском
+    start = bisect.bisect_left(user_message_log, cutoff, key=lambda e: e["timestamp"])
+    users = set()
+    anon_users = set()
+    types_count = {"text": 0, "photo": 0, "video": 0, "other": 0}
+    for e in itertools.islice(user_message_log, start, None):
+        users.add(e["user_id"])
+        if e["is_anon"]:
+            anon_users.add(e["user_id"])
+        kind = e["type"] if e["type"] in types_count else "other"
+        types_count[kind] += 1
+
+    messages = len(user_message_log) - start
+    # период начинается раньше сырого лога - добавляем свертку
+    rollup = user_message_rollup
+    if cutoff < rollup["until"]:
+        messages += rollup["messages"]
+        users |= rollup["users"]
+        anon_users |= rollup["anon_users"]
+        for kind, n in rollup["by_type"].items():
+            types_count[kind] += n
+
+    return {
+        "messages": messages,
+        "unique_users": len(users),
+        "anon_users": len(anon_users),
+        "by_type": types_count,
+    }
 
-    label = build_stats_period_label(period)
 
-    filtered = [e for e in user_message_log if e["timestamp"] >= cutoff]
+def build_stats_text(period: str) -> str:
+    cutoff = stats_cutoff(period, time.time())
+    label = build_stats_period_label(period)
 
-    if not filtered:
+    stats = collect_stats(cutoff)
+    if not stats["messages"]:
         return f"📊 За период {label} сообщений от пользователей не было."
 
-    total = len(filtered)
-    users = {e["user_id"] for e in filtered}
-    text_count = sum(1 for e in filtered if e["type"] == "text")
-    photo_count = sum(1 for e in filtered if e["type"] == "photo")
-    video_count = sum(1 for e in filtered if e["type"] == "video")
-    anon_users_in_period = {e["user_id"] for e in filtered if e["is_anon"]}
-
+    by_type = stats["by_type"]
     text = (
         f"📊 <b>Статистика {label}</b>\n\n"
-        f"Всего сообщений: <b>{total}</b>\n"
-        f"Уникальных пользователей: <b>{len(users)}</b>\n"
-        f"Текстовых сообщений: <b>{text_count}</b>\n"
-        f"Сообщений с фото: <b>{photo_count}</b>\n"
-        f"Сообщений с видео: <b>{video_count}</b>\n"
-        f"Пользователей, писавших анонимно в этот период: <b>{len(anon_users_in_period)}</b>\n"
+        f"Всего сообщений: <b>{stats['messages']}</b>\n"
+        f"Уникальных пользователей: <b>{stats['unique_users']}</b>\n"
+        f"Текстовых сообщений: <b>{by_type['text']}</b>\n"
+        f"Сообщений с фото: <b>{by_type['photo']}</b>\n"
+        f"Сообщений с видео: <b>{by_type['video']}</b>\n"
+        f"Сообщений с другими вложениями: <b>{by_type['other']}</b>\n"
+        f"Пользователей, писавших анонимно в этот период: <b>{stats['anon_users']}</b>\n"
         f"Заблокированных пользователей сейчас: <b>{len(banned_users)}</b>"
     )
-    return text
+    return text + build_analytics_text(cutoff)
 
 
-@dp.callback_query(F.message.chat.id == ADMIN_CHAT_ID, F.data.startswith("stats:"))
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("stats:"))
 async def handle_stats_callback(callback: types.CallbackQuery):
     data = callback.data or ""
     try:
@@ -1110,41 +3169,1433 @@ async def handle_stats_callback(callback: types.CallbackQuery):
 
     if period == "back":
         # возвращаем меню выбора периода
-        await callback.message.edit_text(
-            "Выберите период для статистики:",
-            reply_markup=make_stats_menu_keyboard(),
+        await run_concurrently(
+            callback.message.edit_text(
+                "Выберите период для статистики:",
+                reply_markup=make_stats_menu_keyboard(),
+            ),
+            callback.answer(),
         )
-        await callback.answer()
         return
 
     stats_text = build_stats_text(period)
-    await callback.message.edit_text(
-        stats_text,
-        reply_markup=make_stats_back_keyboard(),
+    await run_concurrently(
+        callback.message.edit_text(
+            stats_text,
+            reply_markup=make_stats_back_keyboard(),
+        ),
+        callback.answer(),
+    )
+
+
+# --- JSON API статистики для дашбордов ---
+
+# без STATS_TOKEN API закрыт токеном экспорта или отладки
+STATS_TOKEN = os.getenv("STATS_TOKEN") or os.getenv("EXPORT_TOKEN") or DEBUG_TOKEN
+
+# даже без новых событий скользящие окна (сутки, неделя) пересчитываем не чаще раза в минуту
+STATS_CACHE_TTL = 60
+# под потоком сообщений version меняется постоянно, а сборка на большом логе занимает
+# заметное время и блокирует event loop: пересобираем не чаще раза в STATS_REBUILD_INTERVAL
+# сек, в промежутке отдаем прошлую сборку с ее etag
+STATS_REBUILD_INTERVAL = float(os.getenv("STATS_REBUILD_INTERVAL", "15"))
+
+STATS_PERIODS = ("day", "week", "month", "all")
+
+# version растет при каждом событии, влияющем на статистику; payload собран для etag
+stats_cache: Dict[str, Any] = {"version": 0, "etag": None, "payload": None, "built_at": 0.0}
+
+
+def invalidate_stats_cache() -> None:
+    stats_cache["version"] += 1
+
+
+def current_stats_etag(now: float) -> str:
+    return f'"{stats_cache["version"]}-{int(now // STATS_CACHE_TTL)}"'
+
+
+def build_stats_payload(now: float) -> Dict[str, Any]:
+    periods = {}
+    for period in STATS_PERIODS:
+        cutoff = stats_cutoff(period, now)
+        stats = collect_stats(cutoff)
+        data = collect_analytics(cutoff)
+        latency = data["latency"]
+        stats.update(
+            {
+                "forwarded": data["forwarded"],
+                "answered": data["answered"],
+                "unanswered": max(data["forwarded"] - data["answered"], 0),
+                "reply_time": {
+                    "p50": latency.quantile(0.5),
+                    "p90": latency.quantile(0.9),
+                    "p99": latency.quantile(0.99),
+                },
+                "hours": data["hours"],
+                "top_senders": [
+                    {"user_id": uid, "messages": n}
+                    for uid, n in data["senders"].top(TOP_SENDERS_SHOWN)
+                ],
+            }
+        )
+        periods[period] = stats
+
+    return {
+        "generated_at": now,
+        "banned_users": len(banned_users),
+        "periods": periods,
+    }
+
+
+@app.get("/api/stats")
+async def api_stats(request: Request):
+    if not STATS_TOKEN:
+        raise HTTPException(status_code=404)
+    token = request.headers.get("X-Stats-Token", "")
+    if not token_matches(token, STATS_TOKEN):
+        raise HTTPException(status_code=403)
+
+    now = time.time()
+    etag = current_stats_etag(now)
+    if stats_cache["etag"] != etag and now - stats_cache["built_at"] >= STATS_REBUILD_INTERVAL:
+        # все клиенты получают одну и ту же заранее сериализованную копию
+        stats_cache["payload"] = json.dumps(build_stats_payload(now), ensure_ascii=False)
+        stats_cache["etag"] = etag
+        stats_cache["built_at"] = now
+
+    etag = stats_cache["etag"]
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=0, must-revalidate"}
+
+    # у клиента уже эта сборка - ничего не отправляем
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=stats_cache["payload"], media_type="application/json", headers=headers)
+
+
+# --- Полнотекстовый поиск по сообщениям (/search) ---
+
+SEARCH_PAGE_SIZE = 5
+
+# SQLite живет в одном отдельном потоке: все запросы к базе идут через этот executor,
+# поэтому event loop не блокируется ни записью в индекс, ни поиском
+search_executor = shared_resource(
+    "search_executor", lambda: ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+)
+search_db: sqlite3.Connection | None = None
+
+# (chat_id, message_id сообщения с результатами) -> поисковый запрос, для листания страниц
+search_queries: Dict[Tuple[int, int], str] = {}
+
+
+def _get_search_db() -> sqlite3.Connection:
+    global search_db
+    if search_db is None:
+        conn = sqlite3.connect(SEARCH_DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY, "
+            "user_id INTEGER NOT NULL, "
+            "timestamp REAL NOT NULL, "
+            "is_anon INTEGER NOT NULL, "
+            "admin_chat_id INTEGER NOT NULL, "
+            "admin_message_id INTEGER NOT NULL, "
+            "body TEXT NOT NULL)"
+        )
+        # external content: текст хранится один раз в messages, FTS хранит только индекс
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "body, content='messages', content_rowid='id', tokenize='unicode61')"
+        )
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN "
+            "INSERT INTO messages_fts(rowid, body) VALUES (new.id, new.body); END"
+        )
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN "
+            "INSERT INTO messages_fts(messages_fts, rowid, body) VALUES ('delete', old.id, old.body); END"
+        )
+        conn.commit()
+        search_db = conn
+    return search_db
+
+
+def _index_message_sync(
+    user_id: int,
+    timestamp: float,
+    is_anon: bool,
+    admin_chat_id: int,
+    admin_message_id: int,
+    body: str,
+) -> None:
+    conn = _get_search_db()
+    conn.execute(
+        "INSERT INTO messages (user_id, timestamp, is_anon, admin_chat_id, admin_message_id, body) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, timestamp, int(is_anon), admin_chat_id, admin_message_id, body),
+    )
+    conn.commit()
+
+
+def _search_sync(query: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+    conn = _get_search_db()
+    # \x02/\x03 - маркеры подсветки, заменяются на <b></b> уже после html.escape
+    rows = conn.execute(
+        "SELECT m.user_id, m.timestamp, m.is_anon, m.admin_chat_id, m.admin_message_id, "
+        "snippet(messages_fts, 0, char(2), char(3), '…', 16) "
+        "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        "WHERE messages_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+        (query, limit, offset),
+    ).fetchall()
+    return [
+        {
+            "user_id": r[0],
+            "timestamp": r[1],
+            "is_anon": bool(r[2]),
+            "admin_chat_id": r[3],
+            "admin_message_id": r[4],
+            "snippet": r[5],
+        }
+        for r in rows
+    ]
+
+
+async def index_message_text(
+    user_id: int,
+    is_anon: bool,
+    admin_chat_id: int,
+    admin_message_id: int,
+    body: str,
+) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(
+            search_executor,
+            _index_message_sync,
+            user_id,
+            time.time(),
+            is_anon,
+            admin_chat_id,
+            admin_message_id,
+            body,
+        )
+    except Exception:
+        logging.exception("Failed to index message from user %s", user_id)
+
+
+def build_fts_query(raw: str) -> str:
+    # каждое слово берем в кавычки, чтобы пользовательский ввод не ломал синтаксис FTS5
+    terms = [t.replace('"', '""') for t in raw.split()]
+    return " ".join(f'"{t}"' for t in terms if t)
+
+
+def build_message_link(chat_id: int, message_id: int) -> str | None:
+    chat_str = str(chat_id)
+    if chat_str.startswith("-100"):
+        return f"https://t.me/c/{chat_str[4:]}/{message_id}"
+    return None
+
+
+def build_search_results_text(query: str, results: List[Dict[str, Any]], page: int) -> str:
+    if not results:
+        if page == 0:
+            return f"🔎 По запросу <b>{html.escape(query)}</b> ничего не найдено."
+        return f"🔎 По запросу <b>{html.escape(query)}</b> больше результатов нет."
+
+    lines = [f"🔎 Результаты по запросу <b>{html.escape(query)}</b> (стр. {page + 1}):"]
+    for i, r in enumerate(results, start=page * SEARCH_PAGE_SIZE + 1):
+        dt_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(r["timestamp"]))
+        who = "аноним" if r["is_anon"] else f"<code>{r['user_id']}</code>"
+        snippet = (
+            html.escape(r["snippet"])
+            .replace("\x02", "<b>")
+            .replace("\x03", "</b>")
+        )
+        link = build_message_link(r["admin_chat_id"], r["admin_message_id"])
+        head = f'<a href="{link}">{dt_str}</a>' if link else dt_str
+        lines.append(f"\n{i}) {head} · {who}\n{snippet}")
+    return "\n".join(lines)
+
+
+def make_search_keyboard(page: int, has_next: bool) -> InlineKeyboardMarkup | None:
+    row = []
+    if page > 0:
+        row.append(
+            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"search:{page - 1}")
+        )
+    if has_next:
+        row.append(
+            InlineKeyboardButton(text="Дальше ➡️", callback_data=f"search:{page + 1}")
+        )
+    if not row:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[row])
+
+
+async def run_search(query: str, page: int) -> Tuple[str, InlineKeyboardMarkup | None]:
+    fts_query = build_fts_query(query)
+    loop = asyncio.get_running_loop()
+    # берем на один результат больше, чтобы понять, есть ли следующая страница
+    results = await loop.run_in_executor(
+        search_executor,
+        _search_sync,
+        fts_query,
+        page * SEARCH_PAGE_SIZE,
+        SEARCH_PAGE_SIZE + 1,
     )
-    await callback.answer()
+    has_next = len(results) > SEARCH_PAGE_SIZE
+    results = results[:SEARCH_PAGE_SIZE]
+    return build_search_results_text(query, results, page), make_search_keyboard(page, has_next)
+
+
+async def edit_search_page(message: types.Message, query: str, page: int) -> None:
+    text, kb = await run_search(query, page)
+    await message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)
+
+
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text.regexp(r"^/search"))
+async def cmd_search(message: types.Message):
+    parts = message.text.split(maxsplit=1)
+    if len(parts) == 1 or not build_fts_query(parts[1]):
+        await message.reply(
+            "Использование команды:\n"
+            "/search текст - найти сообщения пользователей"
+        )
+        return
+
+    query = parts[1].strip()
+    text, kb = await run_search(query, 0)
+    sent = await message.reply(text, reply_markup=kb, disable_web_page_preview=True)
+    search_queries[(sent.chat.id, sent.message_id)] = query
+
+
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("search:"))
+async def handle_search_callback(callback: types.CallbackQuery):
+    data = callback.data or ""
+    try:
+        _, page_str = data.split(":", 1)
+        page = max(int(page_str), 0)
+    except Exception:
+        await callback.answer("Ошибка при выборе страницы.", show_alert=True)
+        return
+
+    query = search_queries.get((callback.message.chat.id, callback.message.message_id))
+    if not query:
+        await callback.answer("Поиск устарел, повторите /search.", show_alert=True)
+        return
+
+    # ответ на нажатие не ждет поиска
+    await run_concurrently(
+        callback.answer(),
+        edit_search_page(callback.message, query, page),
+    )
+
+
+# --- История переписки с пользователем (/history) ---
+
+HISTORY_PAGE_SIZE = 10
+HISTORY_SEGMENT_SIZE = 16 * 1024 * 1024
+HISTORY_PREVIEW_LEN = 300
+
+# заголовок записи: длина текста, user_id, timestamp, направление (0 - от пользователя, 1 - ответ админа)
+HISTORY_HEADER = struct.Struct("<IqdB")
+HISTORY_IN = 0
+HISTORY_OUT = 1
+
+# запись и чтение сегментов - в своем потоке, как и поиск
+history_executor = shared_resource(
+    "history_executor", lambda: ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+)
+
+# user_id -> [(номер сегмента, смещение записи), ...] в порядке записи
+history_index: Dict[int, List[Tuple[int, int]]] = {}
+
+# активный (дописываемый) сегмент
+history_active: Dict[str, Any] = {"segment": 0, "size": 0, "file": None}
+
+# номер сегмента -> mmap только для чтения
+history_maps: Dict[int, mmap.mmap] = {}
+
+
+def _history_segment_path(segment: int) -> str:
+    return os.path.join(HISTORY_DIR, f"{segment:08d}.log")
+
+
+def _load_history_sync() -> Dict[int, List[Tuple[int, int]]]:
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    segments = sorted(
+        int(name[:-4])
+        for name in os.listdir(HISTORY_DIR)
+        if name.endswith(".log") and name[:-4].isdigit()
+    )
+
+    index: Dict[int, List[Tuple[int, int]]] = {}
+    last_segment = segments[-1] if segments else 0
+    last_size = 0
+
+    for segment in segments:
+        path = _history_segment_path(segment)
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, "rb") as f:
+            # читаем только заголовки, тексты пропускаем через seek
+            while offset + HISTORY_HEADER.size <= size:
+                f.seek(offset)
+                length, user_id, _, _ = HISTORY_HEADER.unpack(f.read(HISTORY_HEADER.size))
+                end = offset + HISTORY_HEADER.size + length
+                if end > size:
+                    break
+                index.setdefault(user_id, []).append((segment, offset))
+                offset = end
+
+        if offset < size:
+            # недописанный хвост после падения - обрезаем
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        if segment == last_segment:
+            last_size = offset
+
+    history_active["segment"] = last_segment
+    history_active["size"] = last_size
+    history_active["file"] = open(_history_segment_path(last_segment), "ab")
+    return index
+
+
+def _append_history_sync(user_id: int, timestamp: float, direction: int, text: str) -> Tuple[int, int]:
+    payload = text.encode("utf-8")
+    record_size = HISTORY_HEADER.size + len(payload)
+
+    if history_active["size"] and history_active["size"] + record_size > HISTORY_SEGMENT_SIZE:
+        history_active["file"].close()
+        history_active["segment"] += 1
+        history_active["size"] = 0
+        history_active["file"] = open(_history_segment_path(history_active["segment"]), "ab")
+
+    f = history_active["file"]
+    offset = history_active["size"]
+    f.write(HISTORY_HEADER.pack(len(payload), user_id, timestamp, direction))
+    f.write(payload)
+    f.flush()
+    history_active["size"] += record_size
+    return history_active["segment"], offset
+
+
+def _get_history_map(segment: int, needed: int) -> mmap.mmap:
+    mm = history_maps.get(segment)
+    if mm is None or len(mm) < needed:
+        # активный сегмент растет - переотображаем, если запись за концом старого mmap
+        if mm is not None:
+            mm.close()
+        with open(_history_segment_path(segment), "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        history_maps[segment] = mm
+    return mm
+
+
+def _read_history_sync(positions: List[Tuple[int, int]]) -> List[Dict[str, Any]]:
+    records = []
+    for segment, offset in positions:
+        mm = _get_history_map(segment, offset + HISTORY_HEADER.size)
+        length, user_id, timestamp, direction = HISTORY_HEADER.unpack_from(mm, offset)
+        start = offset + HISTORY_HEADER.size
+        mm = _get_history_map(segment, start + length)
+        records.append(
+            {
+                "user_id": user_id,
+                "timestamp": timestamp,
+                "direction": direction,
+                "text": mm[start:start + length].decode("utf-8", errors="replace"),
+            }
+        )
+    return records
+
+
+def _close_history_sync() -> None:
+    for mm in history_maps.values():
+        mm.close()
+    history_maps.clear()
+    if history_active["file"] is not None:
+        history_active["file"].close()
+        history_active["file"] = None
+
+
+async def load_history() -> None:
+    loop = asyncio.get_running_loop()
+    index = await loop.run_in_executor(history_executor, _load_history_sync)
+    history_index.clear()
+    history_index.update(index)
+
+
+async def close_history() -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(history_executor, _close_history_sync)
+
+
+async def record_history(user_id: int, direction: int, text: str) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+        position = await loop.run_in_executor(
+            history_executor,
+            _append_history_sync,
+            user_id,
+            time.time(),
+            direction,
+            text,
+        )
+    except Exception:
+        logging.exception("Failed to append history record for user %s", user_id)
+        return
+    history_index.setdefault(user_id, []).append(position)
+
+
+def describe_message(message: types.Message) -> str:
+    if message.content_type == "text":
+        return message.text
+    label = f"[{message.content_type}]"
+    if message.caption:
+        return f"{label} {message.caption}"
+    return label
+
+
+async def build_history_page(user_id: int, page: int) -> Tuple[str, InlineKeyboardMarkup | None]:
+    positions = history_index.get(user_id, [])
+    total = len(positions)
+
+    # новые записи сначала: страница 0 - конец списка
+    end = total - page * HISTORY_PAGE_SIZE
+    start = max(end - HISTORY_PAGE_SIZE, 0)
+    if end <= 0:
+        return f"📜 История пользователя <code>{user_id}</code> пуста.", None
+
+    loop = asyncio.get_running_loop()
+    records = await loop.run_in_executor(
+        history_executor,
+        _read_history_sync,
+        positions[start:end][::-1],
+    )
+
+    lines = [f"📜 История пользователя <code>{user_id}</code> (стр. {page + 1}):"]
+    for r in records:
+        dt_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(r["timestamp"]))
+        icon = "📥" if r["direction"] == HISTORY_IN else "📤 Ответ админа,"
+        text = r["text"]
+        if len(text) > HISTORY_PREVIEW_LEN:
+            text = text[:HISTORY_PREVIEW_LEN] + "…"
+        lines.append(f"\n{icon} {dt_str}\n{html.escape(text)}")
+
+    row = []
+    if start > 0:
+        row.append(
+            InlineKeyboardButton(
+                text="⬅️ Раньше",
+                callback_data=f"history:{user_id}:{page + 1}",
+            )
+        )
+    if page > 0:
+        row.append(
+            InlineKeyboardButton(
+                text="Позже ➡️",
+                callback_data=f"history:{user_id}:{page - 1}",
+            )
+        )
+    kb = InlineKeyboardMarkup(inline_keyboard=[row]) if row else None
+    return "\n".join(lines), kb
+
+
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text.regexp(r"^/history"))
+async def cmd_history(message: types.Message):
+    parts = message.text.split(maxsplit=1)
+    try:
+        target_user_id = int(parts[1].strip())
+    except (IndexError, ValueError):
+        await message.reply(
+            "Использование команды:\n"
+            "/history user_id - история переписки с пользователем"
+        )
+        return
+
+    text, kb = await build_history_page(target_user_id, 0)
+    await message.reply(text, reply_markup=kb)
+
+
+@dp.callback_query(F.message.chat.id.in_(ADMIN_CHAT_IDS), F.data.startswith("history:"))
+async def handle_history_callback(callback: types.CallbackQuery):
+    # history:<user_id> - кнопка под пересланным сообщением, история приходит новым сообщением
+    # history:<user_id>:<page> - листание уже открытой истории
+    data = callback.data or ""
+    try:
+        parts = data.split(":")
+        target_user_id = int(parts[1])
+        page = max(int(parts[2]), 0) if len(parts) > 2 else None
+    except Exception:
+        await callback.answer("Ошибка: не могу прочитать ID пользователя.", show_alert=True)
+        return
+
+    async def show_history():
+        text, kb = await build_history_page(target_user_id, page or 0)
+        if page is None:
+            await callback.message.reply(text, reply_markup=kb)
+        else:
+            await callback.message.edit_text(text, reply_markup=kb)
+
+    await run_concurrently(callback.answer(), show_history())
+
+
+# --- Экспорт данных: CSV/JSONL по HTTP и архив по /export ---
+
+# без EXPORT_TOKEN экспорт закрыт тем же токеном, что и отладка
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN") or DEBUG_TOKEN
+
+# сколько строк собирать в один chunk ответа, прежде чем отдать управление event loop
+EXPORT_CHUNK_ROWS = 500
+
+EXPORT_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "messages": ("timestamp", "user_id", "type", "is_anon"),
+    "bans": ("user_id", "timestamp", "name", "username"),
+    "tags": ("user_id", "tags"),
+}
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+}
+
+
+def iter_export_rows(dataset: str, since: float | None, until: float | None) -> Iterator[Dict[str, Any]]:
+    # данные не копируются: лог читается по индексу (дописывают в конец, свертка срезает
+    # начало - позицию пересчитываем через trimmed), у словарей снимается только список ключей
+    if dataset == "messages":
+        with user_message_log_lock:
+            start = 0
+            if since is not None:
+                start = bisect.bisect_left(user_message_log, since, key=lambda e: e["timestamp"])
+            pos = user_message_log_state["trimmed"] + start
+        while True:
+            with user_message_log_lock:
+                # записи, уже ушедшие в свертку, пропускаем
+                i = max(pos - user_message_log_state["trimmed"], 0)
+                if i >= len(user_message_log):
+                    break
+                entry = user_message_log[i]
+                pos = user_message_log_state["trimmed"] + i + 1
+            if until is not None and entry["timestamp"] >= until:
+                break
+            yield {
+                "timestamp": entry["timestamp"],
+                # анонимность сохраняем и в выгрузке
+                "user_id": None if entry["is_anon"] else entry["user_id"],
+                "type": entry["type"],
+                "is_anon": entry["is_anon"],
+            }
+
+    elif dataset == "bans":
+        for user_id in list(ban_log):
+            info = ban_log.get(user_id)
+            if info is None:
+                continue
+            ts = info["timestamp"]
+            if (since is not None and ts < since) or (until is not None and ts >= until):
+                continue
+            yield {
+                "user_id": user_id,
+                "timestamp": ts,
+                "name": info.get("name"),
+                "username": info.get("username"),
+            }
+
+    elif dataset == "tags":
+        # у тегов нет времени, период к ним не применяется
+        for user_id in list(user_tags):
+            tags = user_tags.get(user_id)
+            if tags:
+                yield {"user_id": user_id, "tags": sorted(tags)}
+
+
+def format_export_rows(rows: List[Dict[str, Any]], fields: Tuple[str, ...], fmt: str) -> str:
+    if fmt == "jsonl":
+        return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(
+            [";".join(v) if isinstance(v, list) else ("" if v is None else v) for v in (row[f] for f in fields)]
+        )
+    return buf.getvalue()
+
+
+def format_export_header(fields: Tuple[str, ...], fmt: str) -> str:
+    if fmt != "csv":
+        return ""
+    buf = io.StringIO()
+    csv.writer(buf).writerow(fields)
+    return buf.getvalue()
+
+
+async def stream_export(dataset: str, fmt: str, since: float | None, until: float | None):
+    fields = EXPORT_FIELDS[dataset]
+    header = format_export_header(fields, fmt)
+    if header:
+        yield header
+
+    rows: List[Dict[str, Any]] = []
+    for row in iter_export_rows(dataset, since, until):
+        rows.append(row)
+        if len(rows) >= EXPORT_CHUNK_ROWS:
+            yield format_export_rows(rows, fields, fmt)
+            rows.clear()
+            # большой экспорт не должен задерживать апдейты
+            await asyncio.sleep(0)
+    if rows:
+        yield format_export_rows(rows, fields, fmt)
+
+
+def parse_export_time(value: str | None) -> float | None:
+    # unix-время или ISO-дата (2024-05-01 / 2024-05-01T12:00:00)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Bad time value: {value}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+@app.get("/export/{dataset}")
+async def export_dataset(
+    request: Request,
+    dataset: str,
+    format: str = "csv",
+    since: str | None = None,
+    until: str | None = None,
+):
+    if not EXPORT_TOKEN:
+        raise HTTPException(status_code=404)
+    token = request.headers.get("X-Export-Token", "")
+    if not token_matches(token, EXPORT_TOKEN):
+        raise HTTPException(status_code=403)
+
+    if dataset not in EXPORT_FIELDS:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset: {dataset}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {format}")
+
+    # без Content-Length ответ уходит chunked-кодированием по мере генерации
+    return StreamingResponse(
+        stream_export(dataset, format, parse_export_time(since), parse_export_time(until)),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{dataset}.{format}"'},
+    )
+
+
+def _build_export_archive_sync(path: str, since: float | None) -> None:
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for dataset, fields in EXPORT_FIELDS.items():
+            with archive.open(f"{dataset}.csv", "w") as raw:
+                out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+                out.write(format_export_header(fields, "csv"))
+                rows: List[Dict[str, Any]] = []
+                for row in iter_export_rows(dataset, since, None):
+                    rows.append(row)
+                    if len(rows) >= EXPORT_CHUNK_ROWS:
+                        out.write(format_export_rows(rows, fields, "csv"))
+                        rows.clear()
+                out.write(format_export_rows(rows, fields, "csv"))
+                out.flush()
+                out.detach()
+
+
+@dp.message(F.chat.id.in_(ADMIN_CHAT_IDS), F.text.regexp(r"^/export"))
+async def cmd_export(message: types.Message):
+    parts = message.text.split()
+    days: int | None = None
+    if len(parts) > 1:
+        try:
+            days = int(parts[1])
+            if days <= 0:
+                raise ValueError
+        except ValueError:
+            await message.reply(
+                "Использование команды:\n"
+                "/export - выгрузить все данные\n"
+                "/export 7 - выгрузить данные за последние 7 дней"
+            )
+            return
+
+    since = time.time() - days * 24 * 60 * 60 if days else None
+    fd, path = tempfile.mkstemp(prefix="export-", suffix=".zip")
+    os.close(fd)
+    try:
+        # сжатие в отдельном потоке, event loop продолжает обрабатывать апдейты
+        await asyncio.get_running_loop().run_in_executor(None, _build_export_archive_sync, path, since)
+        period = f"за {days} дн." if days else "за все время"
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        await message.reply_document(
+            FSInputFile(path, filename=f"export-{stamp}.zip"),
+            caption=f"📦 Экспорт {period}: сообщения, баны, теги (CSV).",
+        )
+    finally:
+        os.remove(path)
+
+
+# --- Общая обработка апдейтов (webhook и long polling) ---
+
+
+async def process_update(update: types.Update) -> None:
+    if update.update_id in processed_updates:
+        return
+    processed_updates.add(update.update_id)
+
+    user_id = None
+    if update.message and update.message.from_user:
+        user_id = update.message.from_user.id
+    elif update.callback_query:
+        user_id = update.callback_query.from_user.id
+
+    load_state["inflight_updates"] += 1
+    token = update_deadline.set(time.monotonic() + UPDATE_BUDGET)
+    log_token = log_context.set({"bot": BOT_NAME, "update_id": update.update_id, "user_id": user_id})
+    try:
+        await dp.feed_update(bot, update)
+    finally:
+        log_context.reset(log_token)
+        update_deadline.reset(token)
+        load_state["inflight_updates"] -= 1
+
+
+# --- Long polling: альтернатива webhook (UPDATES_MODE=polling) ---
+
+POLLING_LIMIT = 100
+POLLING_TIMEOUT = 50
+
+# offset следующего запроса getUpdates - все апдейты до него уже обработаны;
+# request - текущий долгий getUpdates, его (и только его) прерываем при остановке
+polling_state: Dict[str, Any] = {"offset": None, "stopping": False, "request": None}
+
+
+def update_order_key(update: types.Update) -> int:
+    # апдейты одного чата обрабатываем по порядку, разные чаты - параллельно
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+async def process_update_chain(updates: List[types.Update]) -> None:
+    for update in updates:
+        try:
+            await process_update(update)
+        except Exception:
+            logging.exception("Failed to process update %s", update.update_id)
+
+
+async def run_polling() -> None:
+    # getUpdates не работает при установленном webhook; ожидающие апдейты не сбрасываем
+    await bot.delete_webhook(drop_pending_updates=False)
+    logging.info("Long polling started")
+
+    while not polling_state["stopping"]:
+        if get_load_level() >= LOAD_LEVEL_REJECT:
+            # не забираем новую пачку, пока не разгребем текущую
+            await asyncio.sleep(1)
+            continue
+
+        request = asyncio.ensure_future(
+            bot.get_updates(
+                offset=polling_state["offset"],
+                limit=POLLING_LIMIT,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=dp.resolve_used_update_types(),
+                request_timeout=POLLING_TIMEOUT + 10,
+            )
+        )
+        polling_state["request"] = request
+        try:
+            updates = await request
+        except asyncio.CancelledError:
+            if polling_state["stopping"]:
+                break
+            raise
+        except Exception:
+            logging.exception("getUpdates failed")
+            await asyncio.sleep(5)
+            continue
+        finally:
+            polling_state["request"] = None
+
+        if not updates:
+            continue
+
+        chains: Dict[int, List[types.Update]] = {}
+        for update in updates:
+            chains.setdefault(update_order_key(update), []).append(update)
+        await asyncio.gather(*(process_update_chain(chain) for chain in chains.values()))
+
+        # подтверждение - следующим getUpdates с offset за последней обработанной пачкой
+        polling_state["offset"] = updates[-1].update_id + 1
+
+    logging.info("Long polling stopped")
+
+
+async def stop_polling(task: asyncio.Task) -> None:
+    # пачку, которую уже обрабатываем, не прерываем - иначе offset за ней не сдвинется
+    # и Telegram пришлет ее заново; прерываем только ожидание следующей
+    polling_state["stopping"] = True
+    request = polling_state["request"]
+    if request is not None:
+        request.cancel()
+    try:
+        await task
+    except Exception:
+        logging.exception("Long polling failed")
+
+    # подтверждаем последнюю обработанную пачку, иначе после переключения
+    # на webhook или перезапуска Telegram пришлет ее еще раз
+    if polling_state["offset"] is not None:
+        try:
+            await bot.get_updates(offset=polling_state["offset"], limit=1, timeout=0)
+        except Exception:
+            logging.exception("Failed to acknowledge polled updates")
 
 
 # --- Webhook FastAPI часть ---
 
+# состояние webhook на момент старта (из getWebhookInfo), показывается в /health
+webhook_state: Dict[str, Any] = {}
+
+
+def webhook_max_connections() -> int:
+    # столько одновременных запросов Telegram, сколько мы готовы принять; у Telegram предел 1..100
+    if not WEB_LIMIT_CONCURRENCY:
+        return 40
+    return max(1, min(100, WEB_LIMIT_CONCURRENCY * WEB_WORKERS))
+
+
+async def setup_webhook() -> None:
+    # присылать только те типы апдейтов, на которые есть хендлеры
+    allowed_updates = dp.resolve_used_update_types()
+    max_connections = webhook_max_connections()
+    try:
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            allowed_updates=allowed_updates,
+            max_connections=max_connections,
+            secret_token=WEBHOOK_SECRET,
+        )
+    except Exception:
+        # webhook (если он был) остался прежним, без нашего секрета - запросы не отсекаем
+        logging.exception("Failed to set webhook")
+        return
+    webhook_state["secret_token_set"] = True
+
+    try:
+        info = await bot.get_webhook_info()
+    except Exception:
+        logging.exception("Failed to get webhook info")
+        return
+
+    webhook_state.update(
+        {
+            "url": info.url,
+            "allowed_updates": info.allowed_updates,
+            "max_connections": info.max_connections,
+            "pending_update_count": info.pending_update_count,
+            "last_error_message": info.last_error_message,
+        }
+    )
+    logging.info(
+        "Webhook set: allowed_updates=%s, max_connections=%s, pending_update_count=%s",
+        ",".join(allowed_updates),
+        max_connections,
+        info.pending_update_count,
+    )
+    if info.last_error_message:
+        logging.warning("Webhook last error: %s", info.last_error_message)
+
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
+    # чужие запросы отсекаем по секрету до любой другой работы
+    if WEBHOOK_SECRET_REQUIRED or webhook_state.get("secret_token_set"):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not token_matches(token, WEBHOOK_SECRET):
+            return JSONResponse(status_code=403, content={"ok": False})
+
+    # перегрузка - отказываем до разбора JSON, Telegram повторит доставку позже
+    if get_load_level() >= LOAD_LEVEL_REJECT:
+        return JSONResponse(
+            status_code=503,
+            content={"ok": False, "retry": True},
+            headers={"Retry-After": "5"},
+        )
+
     try:
         data = await request.json()
     except Exception:
         return JSONResponse(status_code=400, content={"ok": False})
 
     update = types.Update.model_validate(data)
-
-    if update.update_id in processed_updates:
-        return {"ok": True}
-    processed_updates.add(update.update_id)
-
-    await dp.feed_update(bot, update)
+    await process_update(update)
     return {"ok": True}
 
 
 @app.get("/")
 async def root():
     return {"status": "ok", "message": "Telegram bot webhook is running"}
+
+
+@app.get("/health")
+async def health():
+    level = get_load_level()
+    return {
+        "status": "ok" if level < LOAD_LEVEL_REJECT else "overloaded",
+        "updates_mode": UPDATES_MODE,
+        "load_level": level,
+        "load_level_name": LOAD_LEVEL_NAMES[level],
+        "inflight_updates": load_state["inflight_updates"],
+        "outbound_inflight": load_state["outbound_inflight"],
+        "deferred_sends": len(deferred_sends),
+        "api_circuit": "closed" if breaker_state["opened_at"] is None else "open",
+        "webhook": webhook_state or None,
+        "maintenance": {
+            name: {
+                "last_run": stats["last_run"],
+                "last_duration_ms": stats["last_duration_ms"],
+                "errors": stats["errors"],
+            }
+            for name, stats in maintenance_stats.items()
+        },
+    }
+
+
+# --- Отладка памяти: размеры глобальных структур и tracemalloc ---
+
+# глобальные структуры, которые показываем в /debug/memory
+MEMORY_TRACKED = (
+    "user_message_log",
+    "processed_updates",
+    "message_targets",
+    "message_roots",
+    "last_admin_message",
+    "handled_media_groups",
+    "album_posts",
+    "user_settings",
+    "user_tags",
+    "tagged_users",
+    "banned_users",
+    "ban_log",
+    "pending_album_copies",
+    "background_tasks",
+    "search_queries",
+    "history_index",
+    "analytics_buckets",
+    "pending_replies",
+    "flood_clusters",
+    "flood_exact_index",
+    "flood_band_index",
+    "flood_by_message",
+    "deferred_sends",
+    "inbox_items",
+    "inbox_by_user",
+    "digest_pending",
+    "digest_posts",
+)
+
+# у больших контейнеров меряем выборку элементов и экстраполируем, чтобы не стопорить event loop
+MEMORY_SAMPLE_SIZE = 1000
+# и не больше стольких объектов на структуру, как бы ни были вложены ее элементы
+MEMORY_WALK_NODES = 20_000
+
+# последние два снимка tracemalloc: (предыдущий, текущий)
+tracemalloc_snapshots: List[tracemalloc.Snapshot] = []
+
+
+def require_debug_token(request: Request) -> None:
+    # без DEBUG_TOKEN отладочных маршрутов как будто нет
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404)
+    token = request.headers.get("X-Debug-Token", "")
+    if not token_matches(token, DEBUG_TOKEN):
+        raise HTTPException(status_code=403)
+
+
+def deep_sizeof(obj: Any, seen: Set[int], budget: Dict[str, Any]) -> int:
+    # у больших контейнеров на любом уровне меряем первые MEMORY_SAMPLE_SIZE элементов и
+    # экстраполируем: в мелком на верхнем уровне словаре (tagged_users, analytics_buckets)
+    # внутри могут быть миллионы объектов; всего обходим не больше budget["nodes"] объектов
+    if id(obj) in seen or budget["nodes"] <= 0:
+        return 0
+    seen.add(id(obj))
+    budget["nodes"] -= 1
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        children: Any = obj.items()
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        children = obj
+    elif hasattr(obj, "__dict__"):
+        return size + deep_sizeof(vars(obj), seen, budget)
+    else:
+        return size
+
+    sampled = 0
+    walked = 0
+    for child in itertools.islice(children, MEMORY_SAMPLE_SIZE):
+        if budget["nodes"] <= 0:
+            break
+        if isinstance(obj, dict):
+            # сами кортежи (k, v) из items() временные - меряем только ключ и значение
+            key, value = child
+            sampled += deep_sizeof(key, seen, budget) + deep_sizeof(value, seen, budget)
+        else:
+            sampled += deep_sizeof(child, seen, budget)
+        walked += 1
+    if walked < len(obj):
+        budget["estimated"] = True
+    if walked:
+        size += sampled * len(obj) // walked
+    return size
+
+
+def estimate_structure_size(obj: Any) -> Dict[str, Any]:
+    budget: Dict[str, Any] = {"nodes": MEMORY_WALK_NODES, "estimated": False}
+    deep_size = deep_sizeof(obj, set(), budget)
+    return {
+        "entries": len(obj),
+        "deep_size": deep_size,
+        "estimated": budget["estimated"] or budget["nodes"] <= 0,
+    }
+
+
+@app.get("/debug/memory")
+async def debug_memory(request: Request):
+    require_debug_token(request)
+
+    structures = {}
+    for name in MEMORY_TRACKED:
+        structures[name] = estimate_structure_size(globals()[name])
+        # между структурами даем event loop обработать апдейты
+        await asyncio.sleep(0)
+
+    return {
+        "structures": structures,
+        "tracemalloc": {
+            "tracing": tracemalloc.is_tracing(),
+            "snapshots": len(tracemalloc_snapshots),
+        },
+    }
+
+
+@app.post("/debug/tracemalloc/start")
+async def debug_tracemalloc_start(request: Request, frames: int = 1):
+    require_debug_token(request)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    tracemalloc_snapshots.clear()
+    tracemalloc_snapshots.append(tracemalloc.take_snapshot())
+    return {"tracing": True, "frames": tracemalloc.get_traceback_limit()}
+
+
+@app.post("/debug/tracemalloc/snapshot")
+async def debug_tracemalloc_snapshot(request: Request):
+    require_debug_token(request)
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is not started")
+    tracemalloc_snapshots.append(tracemalloc.take_snapshot())
+    del tracemalloc_snapshots[:-2]
+    current, peak = tracemalloc.get_traced_memory()
+    return {"traced_current": current, "traced_peak": peak}
+
+
+@app.get("/debug/tracemalloc/diff")
+async def debug_tracemalloc_diff(request: Request, top: int = 20, key: str = "lineno"):
+    require_debug_token(request)
+    if len(tracemalloc_snapshots) < 2:
+        raise HTTPException(status_code=409, detail="need two snapshots")
+    if key not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="key must be lineno, filename or traceback")
+
+    previous, current = tracemalloc_snapshots
+    stats = current.compare_to(previous, key)[:top]
+    return {
+        "top": [
+            {
+                "where": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                "size_diff": stat.size_diff,
+                "size": stat.size,
+                "count_diff": stat.count_diff,
+                "count": stat.count,
+            }
+            for stat in stats
+        ]
+    }
+
+
+@app.post("/debug/tracemalloc/stop")
+async def debug_tracemalloc_stop(request: Request):
+    require_debug_token(request)
+    tracemalloc.stop()
+    tracemalloc_snapshots.clear()
+    return {"tracing": False}
+
+
+# --- Фоновое обслуживание: чистка и свертка структур в памяти ---
+
+MAINTENANCE_SLICE = 0.005  # сек непрерывной работы, потом отдаем управление event loop
+
+# с запасом дольше окна "Дополнения" (60 с); флуд-кластеры хранят свой пост сами и
+# живут по FLOOD_WINDOW от последнего повтора
+LAST_ADMIN_MESSAGE_TTL = 2 * 60
+PROCESSED_UPDATES_KEEP = 10000  # Telegram повторяет только недавние апдейты
+MEDIA_GROUP_TTL = 10 * 60
+MESSAGE_TARGETS_MAX = 200_000  # на более старые посты ответить уже не получится
+SEARCH_QUERIES_MAX = 1000
+USER_LOG_RAW_RETENTION = 35 * 24 * 60 * 60  # с запасом больше самого длинного периода /stats (месяц)
+
+# name -> {"runs": int, "errors": int, "last_run": float, "last_duration_ms": float,
+#          "max_duration_ms": float, "last_result": Any}
+maintenance_stats: Dict[str, Dict[str, Any]] = {}
+
+
+class TimeSlicer:
+    """Отдает управление event loop, как только работа подряд превысила MAINTENANCE_SLICE."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.checked = 0
+
+    async def tick(self) -> None:
+        self.checked += 1
+        if self.checked % 64:
+            return
+        if time.perf_counter() - self.started >= MAINTENANCE_SLICE:
+            await asyncio.sleep(0)
+            self.started = time.perf_counter()
+
+
+async def expire_merge_state() -> int:
+    cutoff = time.time() - LAST_ADMIN_MESSAGE_TTL
+    slicer = TimeSlicer()
+    removed = 0
+    # порядок словаря - по первому сообщению пользователя, а не по времени: проходим все
+    for user_id in list(last_admin_message):
+        info = last_admin_message.get(user_id)
+        if info is not None and info["time"] < cutoff:
+            del last_admin_message[user_id]
+            removed += 1
+        await slicer.tick()
+    return removed
+
+
+async def compact_processed_updates() -> int:
+    if len(processed_updates) <= PROCESSED_UPDATES_KEEP:
+        return 0
+    snapshot = list(processed_updates)
+    threshold = max(snapshot) - PROCESSED_UPDATES_KEEP
+    slicer = TimeSlicer()
+    removed = 0
+    for update_id in snapshot:
+        if update_id < threshold:
+            processed_updates.discard(update_id)
+            removed += 1
+        await slicer.tick()
+    return removed
+
+
+async def expire_media_groups() -> int:
+    # словарь упорядочен по времени: старые - в начале
+    cutoff = time.time() - MEDIA_GROUP_TTL
+    slicer = TimeSlicer()
+    removed = 0
+    while handled_media_groups:
+        media_group_id = next(iter(handled_media_groups))
+        if handled_media_groups[media_group_id] >= cutoff:
+            break
+        del handled_media_groups[media_group_id]
+        album_posts.pop(media_group_id, None)
+        removed += 1
+        await slicer.tick()
+    return removed
+
+
+async def trim_reply_routes() -> int:
+    # старые посты - в начале словарей
+    slicer = TimeSlicer()
+    removed = 0
+    for routes, limit in (
+        (message_targets, MESSAGE_TARGETS_MAX),
+        (message_roots, MESSAGE_TARGETS_MAX),
+        (search_queries, SEARCH_QUERIES_MAX),
+    ):
+        while len(routes) > limit:
+            del routes[next(iter(routes))]
+            removed += 1
+            await slicer.tick()
+    return removed
+
+
+async def rollup_message_log() -> int:
+    cutoff = time.time() - USER_LOG_RAW_RETENTION
+    count = bisect.bisect_left(user_message_log, cutoff, key=lambda e: e["timestamp"])
+    if not count:
+        return 0
+
+    rollup = user_message_rollup
+    slicer = TimeSlicer()
+    for entry in itertools.islice(user_message_log, count):
+        rollup["messages"] += 1
+        kind = entry["type"] if entry["type"] in rollup["by_type"] else "other"
+        rollup["by_type"][kind] += 1
+        rollup["users"].add(entry["user_id"])
+        if entry["is_anon"]:
+            rollup["anon_users"].add(entry["user_id"])
+        await slicer.tick()
+
+    # в начало лога за время свертки ничего не добавилось - дописывают только в конец
+    with user_message_log_lock:
+        del user_message_log[:count]
+        user_message_log_state["trimmed"] += count
+    rollup["until"] = cutoff
+    return count
+
+
+# name, период (сек), функция; каждая возвращает, сколько записей обработала
+MAINTENANCE_JOBS: List[Tuple[str, float, Callable[[], Awaitable[int]]]] = [
+    ("merge_state", 60, expire_merge_state),
+    ("processed_updates", 5 * 60, compact_processed_updates),
+    ("media_groups", 5 * 60, expire_media_groups),
+    ("reply_routes", 10 * 60, trim_reply_routes),
+    ("message_log_rollup", 60 * 60, rollup_message_log),
+]
+
+
+async def run_maintenance_job(name: str, interval: float, job: Callable[[], Awaitable[int]]) -> None:
+    stats = maintenance_stats.setdefault(
+        name,
+        {
+            "interval": interval,
+            "runs": 0,
+            "errors": 0,
+            "last_run": None,
+            "last_duration_ms": None,
+            "max_duration_ms": 0.0,
+            "last_result": None,
+        },
+    )
+    # первый запуск - в случайный момент периода, дальше период с разбросом ±10%,
+    # чтобы задачи не собирались в одну секунду
+    await asyncio.sleep(random.uniform(0, interval))
+    while True:
+        started = time.perf_counter()
+        try:
+            stats["last_result"] = await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            stats["errors"] += 1
+            logging.exception("Maintenance job %s failed", name)
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        stats["runs"] += 1
+        stats["last_run"] = time.time()
+        stats["last_duration_ms"] = duration_ms
+        stats["max_duration_ms"] = max(stats["max_duration_ms"], duration_ms)
+
+        await asyncio.sleep(interval * random.uniform(0.9, 1.1))
+
+
+async def run_maintenance() -> None:
+    await asyncio.gather(
+        *(run_maintenance_job(name, interval, job) for name, interval, job in MAINTENANCE_JOBS)
+    )
+
+
+@app.get("/debug/maintenance")
+async def debug_maintenance(request: Request):
+    require_debug_token(request)
+    return {"jobs": maintenance_stats}
+
+
+# --- Запуск сервера: python main.py ---
+
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", "8000"))
+# больше одного воркера - это отдельные процессы со своими копиями всех структур в памяти
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+# Telegram держит соединения к webhook открытыми, поэтому keep-alive длиннее дефолтных 5 с
+WEB_KEEPALIVE = int(os.getenv("WEB_KEEPALIVE", "75"))
+WEB_BACKLOG = int(os.getenv("WEB_BACKLOG", "2048"))
+# сверх лимита uvicorn сразу отвечает 503, не создавая задачу под запрос; 0 - без лимита
+WEB_LIMIT_CONCURRENCY = int(os.getenv("WEB_LIMIT_CONCURRENCY", "100"))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "20"))
+
+
+def module_available(name: str) -> bool:
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def build_server_config() -> Dict[str, Any]:
+    # быстрый путь: uvloop и httptools, если они установлены; иначе стандартные asyncio и h11
+    return {
+        "host": WEB_HOST,
+        "port": WEB_PORT,
+        "workers": WEB_WORKERS,
+        "loop": "uvloop" if module_available("uvloop") else "asyncio",
+        "http": "httptools" if module_available("httptools") else "h11",
+        "timeout_keep_alive": WEB_KEEPALIVE,
+        "backlog": WEB_BACKLOG,
+        "limit_concurrency": WEB_LIMIT_CONCURRENCY or None,
+        "timeout_graceful_shutdown": WEB_GRACEFUL_TIMEOUT,
+    }
+
+
+def check_server_config(config: Dict[str, Any]) -> None:
+    if config["workers"] < 1:
+        raise RuntimeError("WEB_WORKERS must be >= 1")
+    if config["workers"] > 1 and UPDATES_MODE == "polling":
+        # два процесса с getUpdates на одном токене мешают друг другу (409 Conflict)
+        raise RuntimeError("UPDATES_MODE=polling requires WEB_WORKERS=1")
+
+    logging.info(
+        "Server config: %s",
+        ", ".join(f"{key}={value}" for key, value in config.items()),
+    )
+    if config["loop"] != "uvloop" or config["http"] != "httptools":
+        logging.warning("uvloop/httptools not installed, running on asyncio + h11")
+    if config["workers"] > 1:
+        logging.warning(
+            "WEB_WORKERS=%s: bans, tags, dedup and reply routing are per-process and not shared",
+            config["workers"],
+        )
+
+
+def run_server() -> None:
+    config = build_server_config()
+    check_server_config(config)
+
+    import uvicorn
+
+    # несколько воркеров uvicorn умеет запускать только по строке импорта;
+    # log_config=None - логи uvicorn идут через наш JSON-логгер
+    uvicorn.run(
+        "main:app" if config["workers"] > 1 else app,
+        log_config=None,
+        proxy_headers=True,
+        **config,
+    )
+
+
+if __name__ == "__main__":
+    run_server()
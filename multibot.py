@@ -0,0 +1,181 @@
+import os
+import re
+import json
+import importlib.util
+from contextlib import asynccontextmanager, AsyncExitStack
+from types import ModuleType
+from typing import Dict, Any, List
+
+from fastapi import FastAPI
+from dotenv import load_dotenv
+
+# Несколько ботов с одной логикой в одном процессе: python multibot.py
+#
+# Каждый бот - отдельная копия main.py со своими глобальными структурами, базами и
+# webhook по адресу /<name><webhook_path>. Общие у всех ботов: пул соединений к Bot API,
+# потоки для SQLite и логирование (словарь HOST_SHARED в main.py).
+#
+# BOTS_CONFIG - JSON-файл со списком ботов:
+# [
+#   {
+#     "name": "feedback",
+#     "token_env": "FEEDBACK_BOT_TOKEN",     # или "token": "123:abc"
+#     "admin_chat_id": -1001234567890,
+#     "webhook_path": "/webhook",            # необязательно
+#     "texts": {"start": {"ru": "...", "en": "..."}},  # необязательно, см. BOT_TEXTS
+#     "env": {"ADMIN_CHAT_IDS": "-100..."}   # необязательно, любые другие настройки main.py
+#   }
+# ]
+#
+# Настройки конкретного бота (BOT_ENV_KEYS: токены, группы, секреты, дайджест, базы) из
+# окружения хоста не наследуются - только из его записи в BOTS_CONFIG. Остальное
+# (LOG_*, WEB_*, LOAD_*, HTTP_POOL_LIMIT и т.п.) - общее для процесса и берется из окружения.
+
+load_dotenv()
+
+BOTS_CONFIG = os.getenv("BOTS_CONFIG", "bots.json")
+# базы и история каждого бота лежат в BOTS_DATA_DIR/<name>/
+BOTS_DATA_DIR = os.getenv("BOTS_DATA_DIR", "bots")
+WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").rstrip("/")
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+# настройки main.py, которые у каждого бота свои: значение хоста (например, общий
+# WEBHOOK_SECRET или ADMIN_CHAT_IDS) молча досталось бы всем ботам сразу
+BOT_ENV_KEYS = (
+    "BOT_NAME",
+    "BOT_TOKEN",
+    "BOT_TEXTS",
+    "ADMIN_CHAT_ID",
+    "ADMIN_CHAT_IDS",
+    "WEBHOOK_URL",
+    "WEBHOOK_PATH",
+    "WEBHOOK_SECRET",
+    "RENDER_EXTERNAL_URL",
+    "UPDATES_MODE",
+    "DEBUG_TOKEN",
+    "STATS_TOKEN",
+    "EXPORT_TOKEN",
+    "DIGEST_MODE",
+    "DIGEST_INTERVAL",
+    "TAG_ALERT_MENTION",
+    "SEARCH_DB_PATH",
+    "HISTORY_DIR",
+    "OUTBOX_DB_PATH",
+)
+# группы по тегам: ADMIN_CHAT_WATCH, ADMIN_CHAT_FAV, ...
+BOT_ENV_PREFIXES = ("ADMIN_CHAT_",)
+
+# общие ресурсы процесса, их подхватывают все копии main.py
+host_shared: Dict[str, Any] = {}
+
+
+def load_bots_config(path: str) -> List[Dict[str, Any]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            configs = json.load(f)
+    except (OSError, ValueError) as e:
+        raise RuntimeError(f"BOTS_CONFIG: can't read {path}: {e}")
+
+    if not isinstance(configs, list) or not configs:
+        raise RuntimeError("BOTS_CONFIG must be a non-empty JSON list")
+
+    names = set()
+    for config in configs:
+        name = config.get("name", "")
+        if not re.fullmatch(r"[a-z0-9_-]+", name):
+            raise RuntimeError(f"BOTS_CONFIG: bad bot name {name!r} (a-z, 0-9, _ and -)")
+        if name in names:
+            raise RuntimeError(f"BOTS_CONFIG: duplicate bot name {name!r}")
+        names.add(name)
+    return configs
+
+
+def build_bot_env(config: Dict[str, Any]) -> Dict[str, str]:
+    name = config["name"]
+    token = config.get("token") or os.getenv(config.get("token_env", ""), "")
+    webhook_path = config.get("webhook_path", "/webhook")
+    data_dir = os.path.join(BOTS_DATA_DIR, name)
+    os.makedirs(data_dir, exist_ok=True)
+
+    env = {
+        "BOT_NAME": name,
+        "BOT_TOKEN": token,
+        "ADMIN_CHAT_ID": str(config.get("admin_chat_id", "")),
+        "WEBHOOK_PATH": webhook_path,
+        "SEARCH_DB_PATH": os.path.join(data_dir, "messages.db"),
+        "HISTORY_DIR": os.path.join(data_dir, "history"),
+        "OUTBOX_DB_PATH": os.path.join(data_dir, "outbox.db"),
+    }
+    if config.get("texts"):
+        env["BOT_TEXTS"] = json.dumps(config["texts"], ensure_ascii=False)
+    if WEBHOOK_BASE_URL:
+        # бот смонтирован под /<name>, Telegram должен стучаться туда же
+        env["WEBHOOK_URL"] = f"{WEBHOOK_BASE_URL}/{name}{webhook_path}"
+    env.update({key: str(value) for key, value in config.get("env", {}).items()})
+    return env
+
+
+def load_bot(config: Dict[str, Any]) -> ModuleType:
+    # main.py читает настройки из окружения при импорте: на время загрузки копии
+    # подставляем окружение этого бота, потом возвращаем исходное
+    saved_env = dict(os.environ)
+    for key in list(os.environ):
+        if key in BOT_ENV_KEYS or key.startswith(BOT_ENV_PREFIXES):
+            del os.environ[key]
+    os.environ.update(build_bot_env(config))
+    try:
+        spec = importlib.util.spec_from_file_location(f"bot_{config['name']}", MAIN_PATH)
+        module = importlib.util.module_from_spec(spec)
+        module.HOST_SHARED = host_shared
+        spec.loader.exec_module(module)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+    return module
+
+
+bots: Dict[str, ModuleType] = {
+    config["name"]: load_bot(config) for config in load_bots_config(BOTS_CONFIG)
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # смонтированные приложения свой lifespan сами не запускают - запускаем их по очереди
+    async with AsyncExitStack() as stack:
+        for module in bots.values():
+            await stack.enter_async_context(module.lifespan(module.app))
+        yield
+
+    connector = host_shared.get("http_connector")
+    if connector is not None:
+        await connector.close()
+    host_shared["log_listener"].stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/")
+async def root():
+    return {"status": "ok", "bots": list(bots)}
+
+
+for _name, _module in bots.items():
+    app.mount(f"/{_name}", _module.app)
+
+
+if __name__ == "__main__":
+    first = next(iter(bots.values()))
+    config = first.build_server_config()
+    first.check_server_config(config)
+
+    import uvicorn
+
+    uvicorn.run(
+        "multibot:app" if config["workers"] > 1 else app,
+        log_config=None,
+        proxy_headers=True,
+        **config,
+    )